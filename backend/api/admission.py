@@ -0,0 +1,232 @@
+import asyncio
+import itertools
+import math
+import os
+import time
+from dotenv import load_dotenv
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from .profiling import stage
+
+# Load environment variables
+load_dotenv()
+
+# Slots shared by analysis and counsel work; health checks have their own pool
+ADMISSION_TOTAL_SLOTS = int(os.getenv("ADMISSION_TOTAL_SLOTS", "8"))
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be served within its class deadline"""
+
+    def __init__(self, priority_class: str, reason: str, retry_after: float):
+        super().__init__(f"Server busy ({priority_class}: {reason}), retry later")
+        self.priority_class = priority_class
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class PriorityClass:
+    """Admission settings and counters for one class of traffic.
+
+    Lower `priority` values are served first when slots free up. `limit` caps
+    concurrent requests of this class, `max_queue` caps waiting ones and
+    `deadline` is how long a request may wait for a slot before it is shed.
+    """
+
+    def __init__(self, name: str, priority: int, limit: int, max_queue: int,
+                 deadline: float, expected_service_time: float, shared: bool = True):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.shared = shared
+        # Exponentially weighted moving average of observed service times
+        self.service_time = expected_service_time
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = {"queue_full": 0, "deadline": 0, "timeout": 0}
+
+    def observe(self, elapsed: float, alpha: float = 0.2):
+        self.service_time = (1 - alpha) * self.service_time + alpha * elapsed
+
+    def to_dict(self) -> dict:
+        return {
+            "priority": self.priority,
+            "active": self.active,
+            "queued": self.queued,
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "deadline_seconds": self.deadline,
+            "avg_service_seconds": round(self.service_time, 3),
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+        }
+
+
+class AdmissionController:
+    """Per-class concurrency limits with bounded, priority-ordered queues.
+
+    All state lives on the event loop thread, so no locking is needed.
+    """
+
+    def __init__(self, classes: list, total_slots: int):
+        self.classes = {c.name: c for c in classes}
+        self.total_slots = total_slots
+        self.shared_active = 0
+        self._waiters = []  # (priority, seq, class, future)
+        self._seq = itertools.count()
+
+    def _can_run(self, pclass: PriorityClass) -> bool:
+        if pclass.active >= pclass.limit:
+            return False
+        return not pclass.shared or self.shared_active < self.total_slots
+
+    def _grant(self, pclass: PriorityClass):
+        pclass.active += 1
+        pclass.admitted += 1
+        if pclass.shared:
+            self.shared_active += 1
+
+    def _dispatch(self):
+        """Hand freed slots to the highest-priority waiters that can run"""
+        for waiter in sorted(self._waiters, key=lambda w: (w[0], w[1])):
+            _, _, pclass, future = waiter
+            if future.done() or not self._can_run(pclass):
+                continue
+            self._waiters.remove(waiter)
+            pclass.queued -= 1
+            self._grant(pclass)
+            future.set_result(None)
+
+    def _has_priority_waiters(self, pclass: PriorityClass) -> bool:
+        return any(w[0] <= pclass.priority and self._can_run(w[2]) for w in self._waiters)
+
+    async def acquire(self, name: str):
+        pclass = self.classes[name]
+        if self._can_run(pclass) and not self._has_priority_waiters(pclass):
+            self._grant(pclass)
+            return
+
+        if pclass.queued >= pclass.max_queue:
+            pclass.shed["queue_full"] += 1
+            raise Overloaded(name, "queue full", pclass.service_time)
+
+        # Requests ahead of us drain at roughly `limit` per service time
+        expected_wait = pclass.service_time * (pclass.queued + 1) / pclass.limit
+        if expected_wait > pclass.deadline:
+            pclass.shed["deadline"] += 1
+            raise Overloaded(name, "deadline", expected_wait)
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (pclass.priority, next(self._seq), pclass, future)
+        self._waiters.append(waiter)
+        pclass.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=pclass.deadline)
+        except asyncio.TimeoutError:
+            if future.done():
+                return  # The slot was granted just as the deadline expired
+            self._abandon(waiter)
+            pclass.shed["timeout"] += 1
+            raise Overloaded(name, "timeout", expected_wait)
+        except asyncio.CancelledError:
+            # Client went away while queued; give back a slot granted in the meantime
+            if future.done():
+                self._free_slot(pclass)
+            else:
+                self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter):
+        self._waiters.remove(waiter)
+        waiter[2].queued -= 1
+        waiter[3].cancel()
+
+    def _free_slot(self, pclass: PriorityClass):
+        pclass.active -= 1
+        if pclass.shared:
+            self.shared_active -= 1
+        self._dispatch()
+
+    def release(self, name: str, elapsed: float):
+        pclass = self.classes[name]
+        pclass.observe(elapsed)
+        self._free_slot(pclass)
+
+    def stats(self) -> dict:
+        return {
+            "shared_active": self.shared_active,
+            "total_slots": self.total_slots,
+            "classes": {name: pclass.to_dict() for name, pclass in self.classes.items()},
+        }
+
+
+admission_controller = AdmissionController(
+    [
+        PriorityClass(
+            "health", priority=0,
+            limit=int(os.getenv("HEALTH_CONCURRENCY", "16")),
+            max_queue=int(os.getenv("HEALTH_QUEUE", "32")),
+            deadline=float(os.getenv("HEALTH_DEADLINE", "1")),
+            expected_service_time=0.01,
+            shared=False
+        ),
+        PriorityClass(
+            "analysis", priority=1,
+            limit=int(os.getenv("ANALYSIS_CONCURRENCY", "8")),
+            max_queue=int(os.getenv("ANALYSIS_QUEUE", "32")),
+            deadline=float(os.getenv("ANALYSIS_DEADLINE", "5")),
+            expected_service_time=0.5
+        ),
+        PriorityClass(
+            "counsel", priority=2,
+            limit=int(os.getenv("COUNSEL_CONCURRENCY", "4")),
+            max_queue=int(os.getenv("COUNSEL_QUEUE", "16")),
+            deadline=float(os.getenv("COUNSEL_DEADLINE", "30")),
+            expected_service_time=8.0
+        ),
+    ],
+    total_slots=ADMISSION_TOTAL_SLOTS
+)
+
+
+def classify_path(path: str):
+    """Map a request path to its priority class, or None if it is not admission-controlled"""
+    if path in ("/health", "/"):
+        return "health"
+    if path in ("/generate/counsel", "/analyze/all"):
+        return "counsel"
+    if path.startswith("/analyze/") or path.startswith("/key-points/") or path == "/clear/history":
+        return "analysis"
+    return None
+
+
+class AdmissionMiddleware(BaseHTTPMiddleware):
+    """Admit, queue or shed each request according to its priority class"""
+
+    def __init__(self, app, controller: AdmissionController = admission_controller):
+        super().__init__(app)
+        self.controller = controller
+
+    async def dispatch(self, request, call_next):
+        name = classify_path(request.url.path)
+        if name is None or request.method == "OPTIONS":
+            return await call_next(request)
+
+        try:
+            with stage("admission"):
+                await self.controller.acquire(name)
+        except Overloaded as e:
+            return JSONResponse(
+                status_code=503,
+                content={"detail": str(e)},
+                headers={"Retry-After": str(e.retry_after)}
+            )
+
+        start = time.monotonic()
+        try:
+            return await call_next(request)
+        finally:
+            self.controller.release(name, time.monotonic() - start)
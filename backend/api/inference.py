@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, Header
 from pydantic import BaseModel
 from typing import Dict, Any, Optional, List
 #import torch
@@ -7,15 +7,26 @@ from dotenv import load_dotenv
 from .models.sentiment_bert import predict_sentiment
 from .models.mental_health_bert import classify_mental_health
 from .models.gemini_counsel import generate_response, clear_history
+from .models.cascade import cascade_stats
+from .models.compiled_bert import compiled_stats
+from .models.storage_manager import storage_manager
+from .admission import AdmissionMiddleware, admission_controller
+from .profiling import ProfilingMiddleware, admin_router, profiled
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import uuid
+import hmac
 
 # Load environment variables
 load_dotenv()
+# Shared with the session-affinity router (router.py); unset disables the /internal routes
+ROUTER_SECRET = os.getenv("ROUTER_SECRET")
 
 app = FastAPI(title="CounselBot API")
 
+# Admission control sits inside CORS so shed (503) responses still carry CORS headers
+app.add_middleware(AdmissionMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -25,6 +36,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so request timelines include time spent queued for admission
+app.add_middleware(ProfilingMiddleware)
+app.include_router(admin_router)
+
 class PromptRequest(BaseModel):
     prompt: str
     clear_history: bool = False
@@ -51,8 +66,20 @@ class AnalysisResponse(BaseModel):
     mental_health: dict
     key_points: List[str]
 
+class SessionTransfer(BaseModel):
+    session: Dict[str, Any]
+
+def require_router_secret(x_router_secret: Optional[str] = Header(default=None)):
+    if not ROUTER_SECRET:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_router_secret or not hmac.compare_digest(x_router_secret, ROUTER_SECRET):
+        raise HTTPException(status_code=403, detail="Invalid router secret")
+
+# Model and Gemini calls block, so these endpoints are plain defs that FastAPI
+# runs in its threadpool, keeping the event loop free for /health
 @app.get("/key-points/{session_id}", response_model=KeyPointsResponse)
-async def get_key_points(session_id: str):
+@profiled
+def get_key_points(session_id: str):
     try:
         from .models.gemini_counsel import gemini_counsel
         session = gemini_counsel.get_session(session_id)
@@ -61,7 +88,8 @@ async def get_key_points(session_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/analyze/sentiment", response_model=SentimentResponse)
-async def analyze_sentiment_endpoint(request: PromptRequest):
+@profiled
+def analyze_sentiment_endpoint(request: PromptRequest):
     try:
         result = predict_sentiment(request.prompt)
         return SentimentResponse(
@@ -72,7 +100,8 @@ async def analyze_sentiment_endpoint(request: PromptRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/analyze/mental-health", response_model=MentalHealthResponse)
-async def analyze_mental_health_endpoint(request: PromptRequest):
+@profiled
+def analyze_mental_health_endpoint(request: PromptRequest):
     try:
         result = classify_mental_health(request.prompt)
         return MentalHealthResponse(
@@ -83,7 +112,8 @@ async def analyze_mental_health_endpoint(request: PromptRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/clear/history")
-async def clear_history_endpoint(request: PromptRequest):
+@profiled
+def clear_history_endpoint(request: PromptRequest):
     try:
         if not request.session_id:
             raise HTTPException(status_code=400, detail="session_id is required")
@@ -93,7 +123,8 @@ async def clear_history_endpoint(request: PromptRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/generate/counsel", response_model=LlamaResponse)
-async def generate_counsel(request: PromptRequest):
+@profiled
+def generate_counsel(request: PromptRequest):
     try:
         # Generate a session ID if not provided
         session_id = request.session_id or str(uuid.uuid4())
@@ -109,7 +140,8 @@ async def generate_counsel(request: PromptRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/analyze/all", response_model=AnalysisResponse)
-async def analyze_all(request: PromptRequest):
+@profiled
+def analyze_all(request: PromptRequest):
     try:
         # Generate a session ID if not provided
         session_id = request.session_id or str(uuid.uuid4())
@@ -128,10 +160,50 @@ async def analyze_all(request: PromptRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# Session ownership handoff between backends, driven by the router:
+# release on the old owner, adopt on the new one, then drop the old owner's copy
+@app.post("/internal/sessions/{session_id}/release", response_model=SessionTransfer,
+          dependencies=[Depends(require_router_secret)])
+@profiled
+def release_session(session_id: str):
+    from .models.gemini_counsel import gemini_counsel
+    return SessionTransfer(session=gemini_counsel.export_session(session_id))
+
+@app.put("/internal/sessions/{session_id}", dependencies=[Depends(require_router_secret)])
+@profiled
+def adopt_session(session_id: str, transfer: SessionTransfer):
+    from .models.gemini_counsel import gemini_counsel
+    gemini_counsel.import_session(session_id, transfer.session)
+    return {"message": "Session adopted"}
+
+@app.delete("/internal/sessions/{session_id}", dependencies=[Depends(require_router_secret)])
+@profiled
+def drop_session(session_id: str):
+    from .models.gemini_counsel import gemini_counsel
+    gemini_counsel.drop_session(session_id)
+    return {"message": "Session dropped"}
+
+@app.on_event("startup")
+def start_session_sweeper():
+    storage_manager.start_sweeper()
+
+@app.on_event("shutdown")
+def stop_session_sweeper():
+    storage_manager.stop()
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "cascade": cascade_stats(),
+        "compiled": compiled_stats(),
+        "sessions": storage_manager.stats(),
+        "admission": admission_controller.stats()
+    }
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to CounselBot API"}
@@ -0,0 +1,444 @@
+"""Confidence-gated cascade in front of the BERT classifiers.
+
+A hashed n-gram linear model (NumPy only) is distilled from BERT outputs and
+answers on its own when it is confident enough; everything else falls through
+to the full BERT forward pass.
+
+Distillation workflow:
+
+    # 1. Bulk-score texts with BERT (one text per line) into a JSONL archive
+    python -m backend.api.models.cascade score --task mental-health \
+        --input texts.txt --output mh_scored.jsonl
+
+    # 2. Train the first stage and calibrate per-label thresholds
+    python -m backend.api.models.cascade train --archive mh_scored.jsonl \
+        --output mh_cascade.npz --target-agreement 0.97
+
+    # 3. Report agreement against BERT on another archive
+    python -m backend.api.models.cascade evaluate --model mh_cascade.npz \
+        --archive mh_holdout.jsonl
+
+Escalation labels (always sent to BERT) are fixed at train time and saved in
+the .npz, so `evaluate` and the deployed cascade apply the same ones. They
+default to DEFAULT_ESCALATE_LABELS that occur in the archive; override with
+repeated `--escalate LABEL`, or `--escalate none`.
+
+Archive records are the classifiers' own output plus the text:
+{"text": ..., "probabilities": {label: percent, ...}}.
+"""
+import argparse
+import json
+import logging
+import re
+import threading
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIM = 2 ** 17
+# Labels the first stage may never answer on its own, when the task has them
+DEFAULT_ESCALATE_LABELS = ("suicidal",)
+_TOKEN_RE = re.compile(r"[a-z0-9']+")
+
+
+def featurize(text: str, dim: int):
+    """Hash word unigrams, word bigrams and character trigrams into `dim` buckets.
+
+    Returns (indices, values) with unique sorted indices and an L2-normalised
+    signed count vector.
+    """
+    tokens = _TOKEN_RE.findall(text.lower())
+    grams = [f"w:{tok}" for tok in tokens]
+    grams += [f"b:{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    for tok in tokens:
+        padded = f"<{tok}>"
+        grams += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    if not grams:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint32, count=len(grams))
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+    indices, inverse = np.unique((hashes % dim).astype(np.int64), return_inverse=True)
+    values = np.zeros(len(indices), dtype=np.float64)
+    np.add.at(values, inverse, signs)
+    norm = np.linalg.norm(values)
+    if norm > 0:
+        values /= norm
+    return indices, values.astype(np.float32)
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class HashedLinearClassifier:
+    """Multinomial logistic regression over hashed n-gram features."""
+
+    def __init__(self, labels, dim: int = DEFAULT_DIM, escalate_labels=None):
+        self.labels = list(labels)
+        self.dim = dim
+        if escalate_labels is None:
+            escalate_labels = [label for label in DEFAULT_ESCALATE_LABELS if label in self.labels]
+        unknown = set(escalate_labels) - set(self.labels)
+        if unknown:
+            raise ValueError(f"Unknown escalation labels {sorted(unknown)}; model labels are {self.labels}")
+        # Labels whose predictions always go to BERT
+        self.escalate_labels = list(escalate_labels)
+        num_labels = len(self.labels)
+        self.weights = np.zeros((dim, num_labels), dtype=np.float32)
+        self.bias = np.zeros(num_labels, dtype=np.float32)
+        # Accept the first-stage answer for label i when its probability >= thresholds[i]
+        self.thresholds = np.full(num_labels, np.inf, dtype=np.float32)
+        # Escalate to BERT when p(label i) >= escalate_thresholds[i] for escalation labels
+        self.escalate_thresholds = np.zeros(num_labels, dtype=np.float32)
+
+    def _logits(self, features) -> np.ndarray:
+        logits = np.tile(self.bias, (len(features), 1))
+        for row, (indices, values) in enumerate(features):
+            if len(indices):
+                logits[row] += values @ self.weights[indices]
+        return logits
+
+    def predict_proba_features(self, features) -> np.ndarray:
+        return _softmax(self._logits(features))
+
+    def predict_proba(self, text: str) -> np.ndarray:
+        return self.predict_proba_features([featurize(text, self.dim)])[0]
+
+    def fit(self, features, targets: np.ndarray, epochs: int = 5, lr: float = 0.5,
+            l2: float = 1e-6, batch_size: int = 64, seed: int = 0):
+        """Fit to BERT's soft labels with Adagrad on the cross-entropy."""
+        rng = np.random.default_rng(seed)
+        grad_sq = np.full_like(self.weights, 1e-8)
+        bias_grad_sq = np.full_like(self.bias, 1e-8)
+        order = np.arange(len(features))
+
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            total_loss = 0.0
+            for start in range(0, len(order), batch_size):
+                batch = [features[i] for i in order[start:start + batch_size]]
+                batch_targets = targets[order[start:start + batch_size]]
+                probs = self.predict_proba_features(batch)
+                total_loss -= float(np.sum(batch_targets * np.log(probs + 1e-12)))
+                delta = (probs - batch_targets) / len(batch)
+
+                rows = np.concatenate([np.full(len(idx), r) for r, (idx, _) in enumerate(batch)])
+                indices = np.concatenate([idx for idx, _ in batch])
+                values = np.concatenate([val for _, val in batch])
+                if len(indices):
+                    touched, inverse = np.unique(indices, return_inverse=True)
+                    grad = np.zeros((len(touched), len(self.labels)), dtype=np.float32)
+                    np.add.at(grad, inverse, delta[rows] * values[:, None])
+                    grad += l2 * self.weights[touched]
+                    grad_sq[touched] += grad ** 2
+                    self.weights[touched] -= lr * grad / np.sqrt(grad_sq[touched])
+
+                bias_grad = delta.sum(axis=0)
+                bias_grad_sq += bias_grad ** 2
+                self.bias -= lr * bias_grad / np.sqrt(bias_grad_sq)
+            logger.info(f"Epoch {epoch + 1}/{epochs}: loss {total_loss / max(len(features), 1):.4f}")
+
+    def calibrate(self, probs: np.ndarray, teacher: np.ndarray,
+                  target_agreement: float = 0.97, escalate_recall: float = 0.99):
+        """Pick per-label thresholds from held-out first-stage probabilities.
+
+        `thresholds[i]` is the lowest confidence at which answers predicted as
+        label i still agree with BERT at `target_agreement`; labels that never
+        get there keep an infinite threshold and always go to BERT.
+        `escalate_thresholds[i]` is the largest p(label i) that still catches
+        `escalate_recall` of the texts BERT assigns to label i.
+        """
+        predicted = probs.argmax(axis=1)
+        confidence = probs.max(axis=1)
+        for label in range(len(self.labels)):
+            mask = predicted == label
+            self.thresholds[label] = np.inf
+            if mask.any():
+                order = np.argsort(-confidence[mask])
+                sorted_conf = confidence[mask][order]
+                agree = (teacher[mask][order] == label).astype(np.float64)
+                running = np.cumsum(agree) / np.arange(1, len(agree) + 1)
+                ok = np.nonzero(running >= target_agreement)[0]
+                if len(ok):
+                    self.thresholds[label] = sorted_conf[ok[-1]]
+
+            positives = probs[teacher == label, label]
+            if len(positives):
+                self.escalate_thresholds[label] = np.quantile(positives, 1.0 - escalate_recall)
+            else:
+                self.escalate_thresholds[label] = 0.0
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path,
+            labels=np.array(self.labels),
+            dim=np.array(self.dim),
+            weights=self.weights,
+            bias=self.bias,
+            thresholds=self.thresholds,
+            escalate_thresholds=self.escalate_thresholds,
+            escalate_labels=np.array(self.escalate_labels, dtype=str),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "HashedLinearClassifier":
+        with np.load(path) as data:
+            # Models saved before escalation labels were stored get the defaults
+            escalate_labels = [str(label) for label in data["escalate_labels"]] if "escalate_labels" in data else None
+            model = cls([str(label) for label in data["labels"]], int(data["dim"]), escalate_labels)
+            model.weights = data["weights"]
+            model.bias = data["bias"]
+            model.thresholds = data["thresholds"]
+            model.escalate_thresholds = data["escalate_thresholds"]
+        return model
+
+
+class CascadeStats:
+    """Thread-safe counters for how often the first stage answered."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.first_stage_hits = 0
+        self.low_confidence = 0
+        self.escalations = 0
+        self.hits_by_label = {}
+
+    def record(self, outcome: str, label: str = None):
+        with self._lock:
+            self.requests += 1
+            if outcome == "hit":
+                self.first_stage_hits += 1
+                self.hits_by_label[label] = self.hits_by_label.get(label, 0) + 1
+            elif outcome == "escalated":
+                self.escalations += 1
+            else:
+                self.low_confidence += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "first_stage_hits": self.first_stage_hits,
+                "low_confidence_fallbacks": self.low_confidence,
+                "forced_escalations": self.escalations,
+                "hit_rate": round(self.first_stage_hits / self.requests, 4) if self.requests else 0.0,
+                "hits_by_label": dict(self.hits_by_label),
+            }
+
+
+# Registry of live cascades, keyed by name, for the metrics endpoint
+_cascades = {}
+
+
+class Cascade:
+    """Route a text to the first-stage model or, when unsure, to BERT.
+
+    `fallback` is the BERT prediction method and `label_key` the field it
+    reports the winning label under ("sentiment", "condition"). With no
+    `model_path` every call goes straight to the fallback. Escalation labels
+    come from the saved model.
+    """
+
+    def __init__(self, name: str, label_key: str, fallback, model_path: str = None):
+        self.name = name
+        self.label_key = label_key
+        self.fallback = fallback
+        self.escalate_labels = set()
+        self.stats = CascadeStats()
+        self.model = None
+        if model_path:
+            logger.info(f"Loading {name} cascade first stage from {model_path}")
+            self.model = HashedLinearClassifier.load(model_path)
+            self.escalate_labels = set(self.model.escalate_labels)
+            logger.info(f"{name} cascade escalates {sorted(self.escalate_labels) or 'no labels'} to BERT")
+        _cascades[name] = self
+
+    def __call__(self, text: str) -> dict:
+        if self.model is None:
+            return self.fallback(text)
+
+        probs = self.model.predict_proba(text)
+        predicted = int(probs.argmax())
+        label = self.model.labels[predicted]
+        if label in self.escalate_labels or any(
+            probs[i] >= self.model.escalate_thresholds[i]
+            for i, name in enumerate(self.model.labels) if name in self.escalate_labels
+        ):
+            self.stats.record("escalated")
+            return self.fallback(text)
+
+        if probs[predicted] < self.model.thresholds[predicted]:
+            self.stats.record("low_confidence")
+            return self.fallback(text)
+
+        self.stats.record("hit", label)
+        return {
+            self.label_key: label,
+            "probabilities": {
+                name: round(float(p) * 100, 2) for name, p in zip(self.model.labels, probs)
+            }
+        }
+
+
+def cascade_stats() -> dict:
+    """Counters for every cascade created in this process."""
+    return {
+        name: dict(cascade.stats.to_dict(), enabled=cascade.model is not None,
+                   escalate_labels=sorted(cascade.escalate_labels))
+        for name, cascade in _cascades.items()
+    }
+
+
+def load_archive(path: str):
+    """Read a bulk-scored JSONL archive into texts and a probability matrix."""
+    texts, rows, labels = [], [], None
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if labels is None:
+                labels = list(record["probabilities"].keys())
+            texts.append(record["text"])
+            rows.append([record["probabilities"][label] for label in labels])
+    if labels is None:
+        raise ValueError(f"Archive {path} is empty")
+    probs = np.asarray(rows, dtype=np.float32)
+    probs /= probs.sum(axis=1, keepdims=True)
+    return texts, probs, labels
+
+
+def agreement_report(model: HashedLinearClassifier, features, teacher_probs: np.ndarray) -> dict:
+    """Compare cascade decisions with BERT's argmax on a scored archive."""
+    probs = model.predict_proba_features(features)
+    teacher = teacher_probs.argmax(axis=1)
+    predicted = probs.argmax(axis=1)
+    accepted = probs.max(axis=1) >= model.thresholds[predicted]
+    for label in model.escalate_labels:
+        i = model.labels.index(label)
+        accepted &= (predicted != i) & (probs[:, i] < model.escalate_thresholds[i])
+
+    agree = predicted == teacher
+    total = len(teacher)
+    report = {
+        "examples": total,
+        "escalate_labels": list(model.escalate_labels),
+        "first_stage_agreement": round(float(agree.mean()), 4),
+        "coverage": round(float(accepted.mean()), 4),
+        "agreement_on_accepted": round(float(agree[accepted].mean()), 4) if accepted.any() else None,
+        # Fallback answers are BERT's own, so they always agree
+        "cascade_agreement": round(float((agree | ~accepted).mean()), 4),
+        "per_label": {},
+    }
+    for i, label in enumerate(model.labels):
+        teacher_mask = teacher == i
+        accepted_mask = accepted & (predicted == i)
+        report["per_label"][label] = {
+            "teacher_count": int(teacher_mask.sum()),
+            "threshold": float(model.thresholds[i]),
+            "accepted": int(accepted_mask.sum()),
+            "agreement_on_accepted": round(float(agree[accepted_mask].mean()), 4) if accepted_mask.any() else None,
+            # Share of BERT's label-i texts that the cascade answered with something else
+            "missed_by_cascade": round(float((accepted & teacher_mask & ~agree).sum() / teacher_mask.sum()), 4) if teacher_mask.any() else None,
+        }
+    return report
+
+
+def _score(args):
+    if args.task == "sentiment":
+        from .sentiment_bert import sentiment_bert
+        predict = sentiment_bert.predict_sentiment
+    else:
+        from .mental_health_bert import mental_health_bert
+        predict = mental_health_bert.classify_mental_health
+
+    count = 0
+    with open(args.input, 'r') as src, open(args.output, 'w') as dst:
+        for line in src:
+            text = line.strip()
+            if not text:
+                continue
+            result = predict(text)
+            dst.write(json.dumps({"text": text, "probabilities": result["probabilities"]}) + "\n")
+            count += 1
+    print(f"Scored {count} texts into {args.output}")
+
+
+def _train(args):
+    texts, teacher_probs, labels = load_archive(args.archive)
+    features = [featurize(text, args.dim) for text in texts]
+
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(texts))
+    split = int(len(order) * (1.0 - args.holdout))
+    train_idx, val_idx = order[:split], order[split:]
+
+    escalate_labels = None
+    if args.escalate is not None:
+        escalate_labels = [] if args.escalate == ["none"] else args.escalate
+    model = HashedLinearClassifier(labels, args.dim, escalate_labels)
+    model.fit([features[i] for i in train_idx], teacher_probs[train_idx],
+              epochs=args.epochs, lr=args.lr, seed=args.seed)
+
+    val_features = [features[i] for i in val_idx]
+    val_probs = model.predict_proba_features(val_features)
+    model.calibrate(val_probs, teacher_probs[val_idx].argmax(axis=1),
+                    target_agreement=args.target_agreement, escalate_recall=args.escalate_recall)
+    model.save(args.output)
+    print(f"Saved first stage to {args.output}")
+
+    report = agreement_report(model, val_features, teacher_probs[val_idx])
+    print(json.dumps(report, indent=2))
+
+
+def _evaluate(args):
+    model = HashedLinearClassifier.load(args.model)
+    texts, teacher_probs, labels = load_archive(args.archive)
+    if labels != model.labels:
+        raise ValueError(f"Archive labels {labels} do not match model labels {model.labels}")
+    features = [featurize(text, model.dim) for text in texts]
+    print(json.dumps(agreement_report(model, features, teacher_probs), indent=2))
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Distil and evaluate the first-stage cascade classifier")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    score = sub.add_parser("score", help="bulk-score texts with BERT into a JSONL archive")
+    score.add_argument("--task", choices=["sentiment", "mental-health"], required=True)
+    score.add_argument("--input", required=True, help="text file, one message per line")
+    score.add_argument("--output", required=True)
+    score.set_defaults(func=_score)
+
+    train = sub.add_parser("train", help="distil the first stage from a scored archive")
+    train.add_argument("--archive", required=True)
+    train.add_argument("--output", required=True)
+    train.add_argument("--dim", type=int, default=DEFAULT_DIM)
+    train.add_argument("--epochs", type=int, default=5)
+    train.add_argument("--lr", type=float, default=0.5)
+    train.add_argument("--holdout", type=float, default=0.1)
+    train.add_argument("--target-agreement", type=float, default=0.97)
+    train.add_argument("--escalate-recall", type=float, default=0.99)
+    train.add_argument("--escalate", action="append", default=None,
+                       help="label that forces BERT (repeatable, saved in the model; 'none' for no labels)")
+    train.add_argument("--seed", type=int, default=0)
+    train.set_defaults(func=_train)
+
+    evaluate = sub.add_parser("evaluate", help="report agreement against BERT")
+    evaluate.add_argument("--model", required=True)
+    evaluate.add_argument("--archive", required=True)
+    evaluate.set_defaults(func=_evaluate)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
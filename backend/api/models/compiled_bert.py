@@ -0,0 +1,216 @@
+"""Opt-in compiled execution of the CustomModel CLS-logits path.
+
+With BERT_COMPILE_MODE=trace (TorchScript) or compile (torch.compile) the
+classifier head path is compiled once per sequence-length bucket at startup.
+Each request is padded up to the smallest bucket that fits it and runs on that
+bucket's graph; longer inputs and batches fall back to the eager model.
+
+Benchmark eager vs compiled latency per bucket:
+
+    python -m backend.api.models.compiled_bert --model sentiment --mode trace
+"""
+import argparse
+import logging
+import os
+import statistics
+import threading
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables
+load_dotenv()
+BERT_COMPILE_MODE = os.getenv("BERT_COMPILE_MODE", "off")  # off | trace | compile
+BERT_COMPILE_BUCKETS = [int(b) for b in os.getenv("BERT_COMPILE_BUCKETS", "16,32,64,128").split(",")]
+
+# Registry of compiled models, keyed by name, for the metrics endpoint
+_compiled_models = {}
+
+
+class CLSLogits(nn.Module):
+    """CustomModel's [CLS] -> logits path with positional tensor inputs, so it can be traced"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.bert = model.bert
+        self.fc = model.fc
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if token_type_ids is not None:
+            inputs["token_type_ids"] = token_type_ids
+        outputs = self.bert(**inputs, return_dict=True)
+        return self.fc(outputs.last_hidden_state[:, 0, :])
+
+
+class CompiledCLSModel:
+    """Dispatch single-text inputs to per-bucket compiled graphs of the CLS-logits path"""
+
+    def __init__(self, name: str, model, tokenizer, device: str, mode: str, buckets):
+        if mode not in ("trace", "compile"):
+            raise ValueError(f"Unknown compile mode: {mode}")
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.mode = mode
+        self.buckets = sorted(buckets)
+        self.graphs = {}
+        self.input_names = None
+        self._lock = threading.Lock()
+        self.hits = {bucket: 0 for bucket in self.buckets}
+        self.fallbacks = 0
+
+    def warmup(self):
+        """Compile one graph per bucket"""
+        module = CLSLogits(self.model).eval()
+        compiled = torch.compile(module, dynamic=False) if self.mode == "compile" else None
+
+        for bucket in self.buckets:
+            example = self.tokenizer(
+                "warmup",
+                return_tensors="pt",
+                padding="max_length",
+                truncation=True,
+                max_length=bucket
+            ).to(self.device)
+            if self.input_names is None:
+                self.input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in example]
+            args = tuple(example[n] for n in self.input_names)
+
+            start = time.perf_counter()
+            with torch.no_grad():
+                if self.mode == "trace":
+                    graph = torch.jit.freeze(torch.jit.trace(module, args))
+                else:
+                    graph = compiled
+                # Run twice: TorchScript optimises on the first calls, torch.compile compiles on the first
+                graph(*args)
+                graph(*args)
+            self.graphs[bucket] = graph
+            logger.info(f"Compiled {self.name} ({self.mode}) for length {bucket} in {time.perf_counter() - start:.2f}s")
+
+        _compiled_models[self.name] = self
+
+    def _pad(self, inputs, bucket: int):
+        seq_len = inputs["input_ids"].shape[1]
+        pad = bucket - seq_len
+        args = []
+        for name in self.input_names:
+            value = self.tokenizer.pad_token_id if name == "input_ids" else 0
+            args.append(F.pad(inputs[name], (0, pad), value=value))
+        return tuple(args)
+
+    def bucket_for(self, inputs):
+        """Smallest bucket that fits the inputs, or None when they need the eager model"""
+        batch, seq_len = inputs["input_ids"].shape
+        if batch != 1 or any(n not in inputs for n in self.input_names):
+            return None
+        for bucket in self.buckets:
+            if seq_len <= bucket:
+                return bucket
+        return None
+
+    def __call__(self, inputs):
+        """Return the logits for tokenized inputs"""
+        bucket = self.bucket_for(inputs)
+        if bucket is None:
+            with self._lock:
+                self.fallbacks += 1
+            logits, _ = self.model(**inputs)
+            return logits
+
+        with self._lock:
+            self.hits[bucket] += 1
+        return self.graphs[bucket](*self._pad(inputs, bucket))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "bucket_hits": {str(b): n for b, n in self.hits.items()},
+                "eager_fallbacks": self.fallbacks,
+            }
+
+
+def compile_for_buckets(name: str, model, tokenizer, device: str):
+    """Build and warm up the compiled runner selected by BERT_COMPILE_MODE, or return None"""
+    if BERT_COMPILE_MODE == "off":
+        return None
+    try:
+        runner = CompiledCLSModel(name, model, tokenizer, device, BERT_COMPILE_MODE, BERT_COMPILE_BUCKETS)
+        runner.warmup()
+        return runner
+    except Exception as e:
+        logger.error(f"Could not compile {name} model, using eager mode: {str(e)}")
+        return None
+
+
+def compiled_stats() -> dict:
+    """Counters for every compiled model in this process"""
+    return {name: runner.stats() for name, runner in _compiled_models.items()}
+
+
+def _time_ms(fn, iterations: int) -> list:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Compare eager and compiled CustomModel latency per length bucket")
+    parser.add_argument("--model", choices=["sentiment", "mental_health"], default="sentiment")
+    parser.add_argument("--mode", choices=["trace", "compile"], default="trace")
+    parser.add_argument("--buckets", default=",".join(str(b) for b in BERT_COMPILE_BUCKETS))
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    if args.model == "mental_health":
+        from .mental_health_bert import mental_health_bert as classifier
+    else:
+        from .sentiment_bert import sentiment_bert as classifier
+
+    buckets = sorted(int(b) for b in args.buckets.split(","))
+    runner = CompiledCLSModel(f"{args.model}-bench", classifier.model, classifier.tokenizer,
+                              classifier.device, args.mode, buckets)
+    runner.warmup()
+
+    print(f"{'bucket':>6} {'tokens':>6} {'eager p50':>10} {'eager p90':>10} {'comp p50':>9} {'comp p90':>9} {'speedup':>8} {'max diff':>9}")
+    previous = 0
+    for bucket in buckets:
+        # Measure a length in the middle of the bucket, so padding cost is included
+        length = max(previous + 1, (previous + bucket) // 2)
+        previous = bucket
+        inputs = classifier.tokenizer(
+            "I have been feeling " + "really " * bucket,
+            return_tensors="pt",
+            truncation=True,
+            max_length=length
+        ).to(classifier.device)
+
+        with torch.no_grad():
+            eager_logits, _ = classifier.model(**inputs)
+            compiled_logits = runner(inputs)
+            eager = _time_ms(lambda: classifier.model(**inputs), args.iterations)
+            compiled = _time_ms(lambda: runner(inputs), args.iterations)
+
+        eager_p50, compiled_p50 = statistics.median(eager), statistics.median(compiled)
+        eager_p90 = statistics.quantiles(eager, n=10)[-1]
+        compiled_p90 = statistics.quantiles(compiled, n=10)[-1]
+        diff = (eager_logits - compiled_logits).abs().max().item()
+        print(f"{bucket:>6} {inputs['input_ids'].shape[1]:>6} {eager_p50:>9.2f}ms {eager_p90:>9.2f}ms "
+              f"{compiled_p50:>8.2f}ms {compiled_p90:>8.2f}ms {eager_p50 / compiled_p50:>7.2f}x {diff:>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,11 @@ class CustomModel(PreTrainedModel):
 
         return output, attentions
 
+    def encode(self, **inputs):
+        """Return the [CLS] representation without running the classification head"""
+        outputs = self.bert(**inputs)
+        return outputs.last_hidden_state[:, 0, :]
+
     def _init_weights(self, module):
         """Initialize the weights"""
         if isinstance(module, nn.Linear):
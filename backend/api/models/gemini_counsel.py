@@ -2,41 +2,169 @@ import google.generativeai as genai
 import os
 from dotenv import load_dotenv
 import re
+import threading
+import time
+import weakref
+from types import SimpleNamespace
 from .storage_manager import storage_manager
+from .session_memory import SessionMemory, embed_text, MEMORY_TOP_K
+from ..profiling import stage
 
 # Load environment variables
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+# "stub" swaps Gemini for StubGenerativeModel, e.g. for RunPod local test mode
+GEMINI_BACKEND = os.getenv("GEMINI_BACKEND", "gemini")
+GEMINI_STUB_LATENCY = float(os.getenv("GEMINI_STUB_LATENCY", "0"))
 
 # Constants for chat history management
 MAX_CHAT_HISTORY = 10  # Maximum number of message pairs to keep
 MAX_KEY_POINTS = 10    # Maximum number of key points to maintain
 
+SYSTEM_PROMPT = """
+You are a supportive, empathetic, and respectful conversational partner. Your primary goal is to assist users with emotional or mental health concerns by providing thoughtful and sensitive responses.
+
+Guidelines for your responses:
+1. Vary your language and avoid repetitive phrases like "thank you" or constantly using the user's name
+2. Focus on understanding and validating emotions rather than just acknowledging them
+3. Use different ways to show empathy and support
+4. Ask thoughtful follow-up questions to encourage deeper discussion
+5. Share relevant insights or perspectives when appropriate
+6. Avoid making assumptions about the user's situation
+7. If unsure, gently ask for clarification
+8. When appropriate, suggest professional support without being pushy
+9. Occasionally, you can make a joke or a light-hearted comment to lighten the mood
+10. Occasionally, you can provide subtle advice or suggestions to help the user
+
+Your tone should be:
+- Warm and understanding
+- Professional but conversational
+- Respectful of boundaries
+- Non-judgmental
+- Encouraging but not overwhelming
+
+Remember:
+- You are CounselBot, but don't introduce yourself repeatedly
+- Focus on the user's needs and emotions
+- Use natural language and avoid formal or clinical terms
+- Keep responses concise but meaningful
+- Don't make lists unless specifically asked
+- Avoid markdown formatting. So don't make italization or bolding when you are writing.
+
+If you're unsure about something, respond with: "I want to make sure I understand correctly. Could you tell me more about that?"
+"""
+
+class StubGenerativeModel:
+    """Offline stand-in for genai.GenerativeModel, for local testing without the Gemini API"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency  # Simulated seconds per call, spread over streamed chunks
+
+    def generate_content(self, prompt: str, stream: bool = False):
+        if "Provide an updated list of key points" in prompt:
+            message = prompt.rsplit('User message: "', 1)[-1].split('"', 1)[0]
+            text = f"- User shared: {message[:80]}"
+        else:
+            text = "That sounds like a lot to carry. What has been weighing on you the most?"
+
+        if not stream:
+            time.sleep(self.latency)
+            return SimpleNamespace(text=text)
+        return self._stream(text)
+
+    def _stream(self, text: str):
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            time.sleep(self.latency / len(words))
+            yield SimpleNamespace(text=word if i == 0 else " " + word)
+
+
 class GeminiCounsel:
     def __init__(self):
         self.model = None
         self.sessions = {}  # Dictionary to store user sessions
+        self.memories = {}  # Vector memory per session, loaded lazily from its sidecar files
+        # Endpoints run in a threadpool, so turns of one session can arrive concurrently;
+        # each session gets its own lock, freed once nothing holds it
+        self._session_locks = weakref.WeakValueDictionary()
+        self._session_locks_guard = threading.Lock()
+        # Drop cached copies once the storage sweeper archives or expires a session,
+        # which it only does while no request holds the session's lock
+        storage_manager.add_eviction_listener(self.evict_session)
+        storage_manager.set_session_lock(self.session_lock)
         self.initialize_model()
         print("GeminiCounsel initialized with empty sessions")
 
     def initialize_model(self):
+        if GEMINI_BACKEND == "stub":
+            print("Using stub Gemini backend")
+            self.model = StubGenerativeModel(GEMINI_STUB_LATENCY)
+            return
+
         # Configure the Gemini API
         genai.configure(api_key=GEMINI_API_KEY)
         
         # Initialize the model
         self.model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
 
+    def session_lock(self, session_id: str):
+        """Lock that serializes reads and updates of one session's history, key points and memory"""
+        with self._session_locks_guard:
+            lock = self._session_locks.get(session_id)
+            if lock is None:
+                lock = self._session_locks[session_id] = threading.RLock()
+            return lock
+
     def get_session(self, session_id: str):
         """Get or create a session for a user"""
-        if session_id not in self.sessions:
-            print(f"Loading session for ID: {session_id}")
-            # Load session from storage
-            self.sessions[session_id] = storage_manager.load_session(session_id)
-            print(f"Loaded session with chat history length: {len(self.sessions[session_id]['chat_history'])}")
-        else:
-            print(f"Retrieved existing session for ID: {session_id}")
-            print(f"Current chat history length: {len(self.sessions[session_id]['chat_history'])}")
-        return self.sessions[session_id]
+        with self.session_lock(session_id):
+            if session_id not in self.sessions:
+                print(f"Loading session for ID: {session_id}")
+                # Load session from storage
+                self.sessions[session_id] = storage_manager.load_session(session_id)
+                print(f"Loaded session with chat history length: {len(self.sessions[session_id]['chat_history'])}")
+            else:
+                print(f"Retrieved existing session for ID: {session_id}")
+                print(f"Current chat history length: {len(self.sessions[session_id]['chat_history'])}")
+            return self.sessions[session_id]
+
+    def evict_session(self, session_id: str):
+        """Forget the in-memory copy of a session; it is reloaded from storage on next use"""
+        self.sessions.pop(session_id, None)
+        self.memories.pop(session_id, None)
+
+    def export_session(self, session_id: str) -> dict:
+        """Return a session's data for handing it to another process.
+
+        The cached copy is dropped but the stored one is kept until
+        drop_session confirms that the other process adopted it.
+        """
+        with self.session_lock(session_id):
+            session = dict(self.get_session(session_id))
+            session['memory_files'] = self.get_memory(session_id).export()
+            self.evict_session(session_id)
+            return session
+
+    def drop_session(self, session_id: str):
+        """Delete every local copy of a session that another process now owns"""
+        with self.session_lock(session_id):
+            self.evict_session(session_id)
+            storage_manager.delete_session(session_id)
+
+    def import_session(self, session_id: str, session_data: dict):
+        """Take ownership of a session handed over by another process"""
+        with self.session_lock(session_id):
+            self.evict_session(session_id)
+            session_data = dict(session_data)
+            SessionMemory.import_files(session_id, session_data.pop('memory_files', {}), storage_manager)
+            storage_manager.save_session(session_id, session_data)
+
+    def get_memory(self, session_id: str) -> SessionMemory:
+        """Get the vector memory of a session, loading it on first use"""
+        with self.session_lock(session_id):
+            if session_id not in self.memories:
+                self.memories[session_id] = SessionMemory.load(session_id, self.get_session(session_id), storage_manager)
+            return self.memories[session_id]
 
     def save_session(self, session_id: str):
         """Save session data to persistent storage"""
@@ -47,11 +175,23 @@ class GeminiCounsel:
     def clean_response(self, text):
         return re.sub(r"^```(?:json)?|```$", "", text.strip(), flags=re.MULTILINE).strip()
 
+    def clean_partial_response(self, text):
+        """Cleaned prefix of a reply still being streamed that later chunks cannot change"""
+        # Hold back a trailing line that may be an unfinished code fence, and any trailing backticks
+        last_line_start = text.rfind("\n") + 1
+        if text[last_line_start:].lstrip().startswith("`"):
+            text = text[:last_line_start]
+        # Backticks first: whitespace before them is only final once they are gone
+        return self.clean_response(text).rstrip("`").rstrip()
+
     def trim_chat_history(self, session: dict):
-        """Trim chat history to keep only the most recent messages"""
+        """Trim chat history to keep only the most recent messages; returns the trimmed ones"""
         if len(session['chat_history']) > MAX_CHAT_HISTORY:
             print(f"Trimming chat history from {len(session['chat_history'])} to {MAX_CHAT_HISTORY} messages")
+            trimmed = session['chat_history'][:-MAX_CHAT_HISTORY]
             session['chat_history'] = session['chat_history'][-MAX_CHAT_HISTORY:]
+            return trimmed
+        return []
 
     def extract_key_point(self, user_input: str, session_id: str):
         session = self.get_session(session_id)
@@ -71,7 +211,8 @@ User message: "{user_input}"
 Provide an updated list of key points that captures the most important emotional concerns from the conversation. Format each point as a single line starting with "- ".
 """
         try:
-            response = self.model.generate_content(summarization_prompt)
+            with stage("gemini.key_points"):
+                response = self.model.generate_content(summarization_prompt)
             if not response or not response.text:
                 return []
             
@@ -97,100 +238,140 @@ Provide an updated list of key points that captures the most important emotional
             print(f"Error extracting key points: {str(e)}")
             return []
 
-    def generate_response(self, prompt: str, session_id: str) -> tuple[str, list[str]]:
+    def prepare_turn(self, prompt: str, session_id: str):
+        """Update key points, recall memory and assemble the full prompt for a new turn"""
         session = self.get_session(session_id)
-        print(f"Generating response for session {session_id}")
-        print(f"Current chat history: {session['chat_history']}")
-        
-        system_prompt = """
-You are a supportive, empathetic, and respectful conversational partner. Your primary goal is to assist users with emotional or mental health concerns by providing thoughtful and sensitive responses.
 
-Guidelines for your responses:
-1. Vary your language and avoid repetitive phrases like "thank you" or constantly using the user's name
-2. Focus on understanding and validating emotions rather than just acknowledging them
-3. Use different ways to show empathy and support
-4. Ask thoughtful follow-up questions to encourage deeper discussion
-5. Share relevant insights or perspectives when appropriate
-6. Avoid making assumptions about the user's situation
-7. If unsure, gently ask for clarification
-8. When appropriate, suggest professional support without being pushy
-9. Occasionally, you can make a joke or a light-hearted comment to lighten the mood
-10. Occasionally, you can provide subtle advice or suggestions to help the user
+        # Extract key point from user input
+        key_points = self.extract_key_point(prompt, session_id)
+        if not key_points:
+            key_points = []
 
-Your tone should be:
-- Warm and understanding
-- Professional but conversational
-- Respectful of boundaries
-- Non-judgmental
-- Encouraging but not overwhelming
+        # Recall older turns that fell out of the chat history window
+        memory = self.get_memory(session_id)
+        prompt_vector = None
+        recalled = []
+        if MEMORY_TOP_K > 0:
+            try:
+                prompt_vector = embed_text(prompt)
+                recalled = memory.search(prompt_vector, MEMORY_TOP_K)
+                print(f"Recalled {len(recalled)} of {len(memory)} remembered turns")
+            except Exception as e:
+                print(f"Error recalling session memory: {str(e)}")
 
-Remember:
-- You are CounselBot, but don't introduce yourself repeatedly
-- Focus on the user's needs and emotions
-- Use natural language and avoid formal or clinical terms
-- Keep responses concise but meaningful
-- Don't make lists unless specifically asked
-- Avoid markdown formatting. So don't make italization or bolding when you are writing.
+        # Build the full prompt with context
+        full_prompt = SYSTEM_PROMPT + "\n\n"
 
-If you're unsure about something, respond with: "I want to make sure I understand correctly. Could you tell me more about that?"
-"""
-        try:
-            # Extract key point from user input
-            key_points = self.extract_key_point(prompt, session_id)
-            if not key_points:
-                key_points = []
+        if key_points:
+            full_prompt += "Important context from earlier:\n" + "\n".join(f"- {m}" for m in key_points) + "\n\n"
+
+        if recalled:
+            full_prompt += "Relevant moments from earlier in the conversation:\n"
+            for user_msg, bot_msg in recalled:
+                full_prompt += f"User: {user_msg}\nCounselBot: {bot_msg}\n"
+            full_prompt += "\n"
+
+        if session['chat_history']:
+            full_prompt += "Chat history:\n"
+            for user_msg, bot_msg in session['chat_history']:
+                full_prompt += f"User: {user_msg}\nCounselBot: {bot_msg}\n"
+            full_prompt += "\n"
+
+        full_prompt += f"User: {prompt}\nCounselBot:"
+        print(f"Full prompt with history: {full_prompt}")
+
+        return full_prompt, key_points, prompt_vector
+
+    def record_turn(self, session_id: str, prompt: str, response_text: str, prompt_vector=None):
+        """Append a finished turn to the chat history and memory, then persist the session"""
+        session = self.get_session(session_id)
+
+        # Update chat history
+        session['chat_history'].append((prompt, response_text))
+        memory = self.get_memory(session_id)
+        memory.add(session, prompt_vector)
 
-            # Build the full prompt with context
-            full_prompt = system_prompt + "\n\n"
+        # Trim chat history if necessary; trimmed turns stay recallable through the memory
+        memory.index_trimmed(session, self.trim_chat_history(session))
 
-            if key_points:
-                full_prompt += "Important context from earlier:\n" + "\n".join(f"- {m}" for m in key_points) + "\n\n"
+        print(f"Updated chat history length: {len(session['chat_history'])}")
 
-            if session['chat_history']:
-                full_prompt += "Chat history:\n"
-                for user_msg, bot_msg in session['chat_history']:
-                    full_prompt += f"User: {user_msg}\nCounselBot: {bot_msg}\n"
-                full_prompt += "\n"
+        # Save session after updating chat history
+        self.save_session(session_id)
 
-            full_prompt += f"User: {prompt}\nCounselBot:"
-            print(f"Full prompt with history: {full_prompt}")
+    def generate_response(self, prompt: str, session_id: str) -> tuple[str, list[str]]:
+        session = self.get_session(session_id)
+        print(f"Generating response for session {session_id}")
+        print(f"Current chat history: {session['chat_history']}")
+        
+        try:
+            # The lock is not held while Gemini replies; concurrent turns are recorded in finishing order
+            with self.session_lock(session_id):
+                full_prompt, key_points, prompt_vector = self.prepare_turn(prompt, session_id)
 
             # Generate response using Gemini
-            response = self.model.generate_content(full_prompt)
+            with stage("gemini.reply"):
+                response = self.model.generate_content(full_prompt)
             if not response or not response.text:
                 raise Exception("Empty response from Gemini model")
             
             response_text = self.clean_response(response.text)
-
-            # Update chat history
-            session['chat_history'].append((prompt, response_text))
-            
-            # Trim chat history if necessary
-            self.trim_chat_history(session)
-            
-            print(f"Updated chat history length: {len(session['chat_history'])}")
-            
-            # Save session after updating chat history
-            self.save_session(session_id)
+            with self.session_lock(session_id):
+                self.record_turn(session_id, prompt, response_text, prompt_vector)
 
             return response_text, key_points
         except Exception as e:
             print(f"Error in generate_response: {str(e)}")
             raise Exception(f"Error generating response from CounselBot: {str(e)}")
 
+    def generate_response_stream(self, prompt: str, session_id: str):
+        """Stream a reply: yields {'delta': text} chunks as Gemini produces them,
+        then {'response': full_text, 'key_points': [...]} once the turn is saved.
+        Deltas are cleaned like the final response, so they add up to it."""
+        print(f"Streaming response for session {session_id}")
+
+        try:
+            # Each step may run on a different worker thread, so the lock is only held within one
+            with self.session_lock(session_id):
+                full_prompt, key_points, prompt_vector = self.prepare_turn(prompt, session_id)
+
+            chunks = []
+            shown = ""
+            with stage("gemini.reply"):
+                for chunk in self.model.generate_content(full_prompt, stream=True):
+                    if chunk.text:
+                        chunks.append(chunk.text)
+                        visible = self.clean_partial_response("".join(chunks))
+                        if len(visible) > len(shown) and visible.startswith(shown):
+                            yield {'delta': visible[len(shown):]}
+                            shown = visible
+
+            response_text = self.clean_response("".join(chunks))
+            if not response_text:
+                raise Exception("Empty response from Gemini model")
+            with self.session_lock(session_id):
+                self.record_turn(session_id, prompt, response_text, prompt_vector)
+
+            yield {'response': response_text, 'key_points': key_points}
+        except Exception as e:
+            print(f"Error in generate_response_stream: {str(e)}")
+            raise Exception(f"Error generating response from CounselBot: {str(e)}")
+
     def clear_history(self, session_id: str):
         """Clear chat history and memorized messages for a specific session"""
         print(f"Clearing history for session {session_id}")
-        session = self.get_session(session_id)
-        session['chat_history'] = []
-        session['memorized_key_messages'] = []
-        print(f"History cleared. New chat history length: {len(session['chat_history'])}")
-        
-        # Save empty session
-        self.save_session(session_id)
-        
-        # Delete session file
-        storage_manager.delete_session(session_id)
+        with self.session_lock(session_id):
+            session = self.get_session(session_id)
+            session['chat_history'] = []
+            session['memorized_key_messages'] = []
+            self.get_memory(session_id).clear(session)
+            print(f"History cleared. New chat history length: {len(session['chat_history'])}")
+
+            # Save empty session
+            self.save_session(session_id)
+
+            # Delete session file
+            storage_manager.delete_session(session_id)
 
 # Create singleton instance
 gemini_counsel = GeminiCounsel()
@@ -198,5 +379,8 @@ gemini_counsel = GeminiCounsel()
 def generate_response(prompt: str, session_id: str) -> tuple[str, list[str]]:
     return gemini_counsel.generate_response(prompt, session_id)
 
+def generate_response_stream(prompt: str, session_id: str):
+    return gemini_counsel.generate_response_stream(prompt, session_id)
+
 def clear_history(session_id: str):
     gemini_counsel.clear_history(session_id) 
\ No newline at end of file
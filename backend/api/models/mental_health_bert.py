@@ -4,6 +4,9 @@ import torch.nn.functional as F
 import os
 from dotenv import load_dotenv
 from .custom_bert import CustomModel
+from .cascade import Cascade
+from .compiled_bert import compile_for_buckets
+from ..profiling import stage
 import logging
 from huggingface_hub import hf_hub_download
 
@@ -15,11 +18,14 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 HUGGINGFACE_TOKEN = os.getenv("HUGGINGFACE_TOKEN")
 MENTAL_HEALTH_MODEL = os.getenv("MENTAL_HEALTH_MODEL", "mental/mental-health-classifier")
+# Optional distilled first-stage model (see cascade.py); unset disables the cascade
+MENTAL_HEALTH_CASCADE_PATH = os.getenv("MENTAL_HEALTH_CASCADE_PATH")
 
 class MentalHealthBERT:
     def __init__(self):
         self.model = None
         self.tokenizer = None
+        self.compiled = None  # Per-length-bucket compiled graphs, when BERT_COMPILE_MODE is set
         self.device = self._get_device()
         self.initialize_model()
 
@@ -100,6 +106,7 @@ class MentalHealthBERT:
             self.model.load_state_dict(remapped_state_dict)
             self.model = self.model.to(self.device)
             self.model.eval()  # Set to evaluation mode
+            self.compiled = compile_for_buckets("mental_health", self.model, self.tokenizer, self.device)
             
             logger.info("Model loaded successfully")
             
@@ -107,22 +114,44 @@ class MentalHealthBERT:
             logger.error(f"Error loading model: {str(e)}")
             raise
 
+    def embed(self, text: str):
+        """Return the [CLS] embedding of the text as a NumPy vector"""
+        if self.model is None:
+            raise RuntimeError("Model not initialized")
+
+        with stage("mental_health.embed"):
+            inputs = self.tokenizer(
+                text,
+                return_tensors="pt",
+                truncation=True,
+                max_length=512
+            ).to(self.device)
+
+            with torch.no_grad():
+                feature = self.model.encode(**inputs)
+
+        return feature[0].float().cpu().numpy()
+
     def classify_mental_health(self, text: str) -> dict:
         if self.model is None:
             raise RuntimeError("Model not initialized")
             
         # Tokenize input
-        inputs = self.tokenizer(
-            text,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=512
-        ).to(self.device)
+        with stage("mental_health.tokenize"):
+            inputs = self.tokenizer(
+                text,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=512
+            ).to(self.device)
 
         # Get prediction
-        with torch.no_grad():
-            logits, _ = self.model(**inputs)  # Unpack the tuple returned by the model
+        with torch.no_grad(), stage("mental_health.forward"):
+            if self.compiled is not None:
+                logits = self.compiled(inputs)
+            else:
+                logits, _ = self.model(**inputs)  # Unpack the tuple returned by the model
             probabilities = F.softmax(logits, dim=1)
             predicted_class = torch.argmax(logits, dim=1).item()
 
@@ -150,6 +179,12 @@ class MentalHealthBERT:
 
 # Create singleton instance
 mental_health_bert = MentalHealthBERT()
+mental_health_cascade = Cascade(
+    "mental_health",
+    "condition",
+    mental_health_bert.classify_mental_health,
+    MENTAL_HEALTH_CASCADE_PATH
+)
 
 def classify_mental_health(text: str) -> dict:
-    return mental_health_bert.classify_mental_health(text) 
\ No newline at end of file
+    return mental_health_cascade(text) 
\ No newline at end of file
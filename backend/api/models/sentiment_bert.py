@@ -4,6 +4,9 @@ import torch.nn.functional as F
 import os
 from dotenv import load_dotenv
 from .custom_bert import CustomModel
+from .cascade import Cascade
+from .compiled_bert import compile_for_buckets
+from ..profiling import stage
 import logging
 from huggingface_hub import hf_hub_download
 
@@ -15,11 +18,14 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 HUGGINGFACE_TOKEN = os.getenv("HUGGINGFACE_TOKEN")
 SENTIMENT_MODEL = os.getenv("SENTIMENT_MODEL", "Mekuu/BERT-A-Sentiment")
+# Optional distilled first-stage model (see cascade.py); unset disables the cascade
+SENTIMENT_CASCADE_PATH = os.getenv("SENTIMENT_CASCADE_PATH")
 
 class SentimentBERT:
     def __init__(self):
         self.model = None
         self.tokenizer = None
+        self.compiled = None  # Per-length-bucket compiled graphs, when BERT_COMPILE_MODE is set
         self.device = self._get_device()
         self.initialize_model()
 
@@ -100,6 +106,7 @@ class SentimentBERT:
             self.model.load_state_dict(remapped_state_dict)
             self.model = self.model.to(self.device)
             self.model.eval()  # Set to evaluation mode
+            self.compiled = compile_for_buckets("sentiment", self.model, self.tokenizer, self.device)
             
             logger.info("Model loaded successfully")
             
@@ -107,22 +114,44 @@ class SentimentBERT:
             logger.error(f"Error loading model: {str(e)}")
             raise
 
+    def embed(self, text: str):
+        """Return the [CLS] embedding of the text as a NumPy vector"""
+        if self.model is None:
+            raise RuntimeError("Model not initialized")
+
+        with stage("sentiment.embed"):
+            inputs = self.tokenizer(
+                text,
+                return_tensors="pt",
+                truncation=True,
+                max_length=512
+            ).to(self.device)
+
+            with torch.no_grad():
+                feature = self.model.encode(**inputs)
+
+        return feature[0].float().cpu().numpy()
+
     def predict_sentiment(self, text: str) -> dict:
         if self.model is None:
             raise RuntimeError("Model not initialized")
             
         # Tokenize input
-        inputs = self.tokenizer(
-            text,
-            return_tensors="pt",
-            padding=True,
-            truncation=True,
-            max_length=512
-        ).to(self.device)
+        with stage("sentiment.tokenize"):
+            inputs = self.tokenizer(
+                text,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=512
+            ).to(self.device)
 
         # Get prediction
-        with torch.no_grad():
-            logits, _ = self.model(**inputs)  # Unpack the tuple returned by the model
+        with torch.no_grad(), stage("sentiment.forward"):
+            if self.compiled is not None:
+                logits = self.compiled(inputs)
+            else:
+                logits, _ = self.model(**inputs)  # Unpack the tuple returned by the model
             probabilities = F.softmax(logits, dim=1)
             predicted_class = torch.argmax(logits, dim=1).item()
 
@@ -149,6 +178,12 @@ class SentimentBERT:
 
 # Create singleton instance
 sentiment_bert = SentimentBERT()
+sentiment_cascade = Cascade(
+    "sentiment",
+    "sentiment",
+    sentiment_bert.predict_sentiment,
+    SENTIMENT_CASCADE_PATH
+)
 
 def predict_sentiment(text: str) -> dict:
-    return sentiment_bert.predict_sentiment(text) 
\ No newline at end of file
+    return sentiment_cascade(text) 
\ No newline at end of file
@@ -0,0 +1,158 @@
+import base64
+import json
+import os
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Number of past turns recalled into each counsel prompt (0 disables the memory)
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "3"))
+# Maximum number of turns indexed per session; the oldest are dropped first
+MEMORY_MAX_TURNS = int(os.getenv("MEMORY_MAX_TURNS", "500"))
+# Minimum cosine similarity for a past turn to be recalled
+MEMORY_MIN_SIMILARITY = float(os.getenv("MEMORY_MIN_SIMILARITY", "0.0"))
+# Which classifier's [CLS] vector is used as the embedding: "sentiment" or "mental_health"
+MEMORY_EMBEDDER = os.getenv("MEMORY_EMBEDDER", "sentiment")
+
+# Sidecar files of the session in storage (see StorageManager.SIDECAR_SUFFIXES)
+VECTORS_SUFFIX = ".vectors"
+TURNS_SUFFIX = ".turns.jsonl"
+
+
+def embed_text(text: str) -> np.ndarray:
+    """Embed text with the [CLS] vector of the configured BERT classifier"""
+    # Imported lazily so the counsel module does not pull in the BERT models at import time
+    if MEMORY_EMBEDDER == "mental_health":
+        from .mental_health_bert import mental_health_bert as embedder
+    else:
+        from .sentiment_bert import sentiment_bert as embedder
+    return embedder.embed(text)
+
+
+def _normalise(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class SessionMemory:
+    """Vector index over the turns of a session that left the chat history window.
+
+    Each recorded turn appends its L2-normalised float16 vector to the
+    session's .vectors sidecar file; its text is appended to the .turns.jsonl
+    sidecar only once the turn is trimmed out of chat_history, so row i of the
+    vectors belongs to line i of the turns and the rows past the last line
+    belong to turns still in the chat history. The session JSON only keeps the
+    vector size and which chat_history entries have a row, under 'memory'.
+    """
+
+    def __init__(self, session_id: str, storage, vectors: np.ndarray = None, turns: list = None):
+        self.session_id = session_id
+        self.storage = storage
+        self.vectors = vectors  # Rows of indexed turns, then rows of turns still in chat_history
+        self.turns = turns or []
+
+    @classmethod
+    def load(cls, session_id: str, session: dict, storage) -> "SessionMemory":
+        meta = session.get('memory')
+        if not meta:
+            return cls(session_id, storage)
+
+        raw = storage.read_sidecar(session_id, VECTORS_SUFFIX)
+        vectors = np.frombuffer(raw[:len(raw) - len(raw) % (2 * meta['dim'])], dtype=np.float16)
+        vectors = vectors.reshape(-1, meta['dim']).copy()
+        lines = storage.read_sidecar(session_id, TURNS_SUFFIX).decode('utf-8').splitlines()
+        turns = [tuple(json.loads(line)) for line in lines if line]
+
+        # A crash between appending a row and saving the session leaves extra rows
+        expected = len(turns) + sum(meta['pending'])
+        if len(vectors) != expected:
+            print(f"Session memory for {session_id} has {len(vectors)} rows, expected {expected}; repairing")
+            turns = turns[:len(vectors)]
+            if len(vectors) < len(turns) + sum(meta['pending']):
+                # Rows of the turns still in chat_history are lost; they will not be indexed
+                meta['pending'] = [False] * len(meta['pending'])
+            vectors = vectors[:len(turns) + sum(meta['pending'])]
+            storage.write_sidecar(session_id, VECTORS_SUFFIX, vectors.tobytes())
+        return cls(session_id, storage, vectors if len(vectors) else None, turns)
+
+    @staticmethod
+    def _encode_turns(turns) -> bytes:
+        return "".join(json.dumps(list(turn)) + "\n" for turn in turns).encode('utf-8')
+
+    def __len__(self):
+        return len(self.turns)
+
+    def add(self, session: dict, vector: np.ndarray = None):
+        """Record the turn just appended to chat_history; vector is None if it could not be embedded"""
+        if vector is not None and session.get('memory') is None:
+            session['memory'] = {'dim': int(np.asarray(vector).shape[-1]), 'pending': []}
+        meta = session.get('memory')
+        if meta is None:
+            return
+        # Chat history entries from before the memory started have no flag
+        meta['pending'].append(vector is not None)
+        if vector is None:
+            return
+
+        row = _normalise(vector).astype(np.float16)[None, :]
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+        self.storage.append_sidecar(self.session_id, VECTORS_SUFFIX, row.tobytes())
+
+    def index_trimmed(self, session: dict, trimmed: list):
+        """Make turns trimmed off the front of chat_history searchable"""
+        meta = session.get('memory')
+        if meta is None or not trimmed:
+            return
+        # chat_history held len(chat_history) + len(trimmed) turns; only the last len(pending) have a flag
+        unflagged = len(session['chat_history']) + len(trimmed) - len(meta['pending'])
+        flags = meta['pending'][:max(0, len(trimmed) - unflagged)]
+        del meta['pending'][:len(flags)]
+        new_turns = [tuple(turn) for turn, has_row in zip(trimmed[len(trimmed) - len(flags):], flags) if has_row]
+        if not new_turns:
+            return
+
+        self.turns.extend(new_turns)
+        if len(self.turns) > MEMORY_MAX_TURNS + MEMORY_MAX_TURNS // 4:
+            # Compact once in a while rather than rewriting the files every turn
+            drop = len(self.turns) - MEMORY_MAX_TURNS
+            self.turns = self.turns[drop:]
+            self.vectors = self.vectors[drop:]
+            self.storage.write_sidecar(self.session_id, VECTORS_SUFFIX, self.vectors.tobytes())
+            self.storage.write_sidecar(self.session_id, TURNS_SUFFIX, self._encode_turns(self.turns))
+        else:
+            self.storage.append_sidecar(self.session_id, TURNS_SUFFIX, self._encode_turns(new_turns))
+
+    def search(self, vector: np.ndarray, k: int) -> list:
+        """Return up to k indexed turns most similar to the vector, oldest first"""
+        candidates = len(self.turns)
+        if k <= 0 or candidates <= 0:
+            return []
+
+        scores = self.vectors[:candidates].astype(np.float32) @ _normalise(vector)
+
+        k = min(k, candidates)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = [i for i in top if scores[i] >= MEMORY_MIN_SIMILARITY]
+        return [self.turns[i] for i in sorted(top)]
+
+    def clear(self, session: dict):
+        self.vectors = None
+        self.turns = []
+        session.pop('memory', None)
+        self.storage.write_sidecar(self.session_id, VECTORS_SUFFIX, b"")
+        self.storage.write_sidecar(self.session_id, TURNS_SUFFIX, b"")
+
+    def export(self) -> dict:
+        """Sidecar contents for handing the session to another process"""
+        return {
+            suffix: base64.b64encode(self.storage.read_sidecar(self.session_id, suffix)).decode('ascii')
+            for suffix in (VECTORS_SUFFIX, TURNS_SUFFIX)
+        }
+
+    @staticmethod
+    def import_files(session_id: str, files: dict, storage):
+        for suffix, data in files.items():
+            storage.write_sidecar(session_id, suffix, base64.b64decode(data))
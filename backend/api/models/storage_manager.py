@@ -1,34 +1,210 @@
+import argparse
+import gzip
+import hashlib
 import json
 import os
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
+from dotenv import load_dotenv
+from ..profiling import stage
+
+# Load environment variables
+load_dotenv()
+
+# Lifecycle settings, in seconds of inactivity since the session was last saved
+SESSION_COLD_AFTER = float(os.getenv("SESSION_COLD_AFTER", str(24 * 3600)))  # move to the compressed archive
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(30 * 24 * 3600)))  # delete for good
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "600"))  # 0 disables the sweeper
+# Storage root of this process (defaults to backend/storage). Processes behind the
+# session router must not share one, since a handoff deletes the old owner's copy.
+SESSION_STORAGE_DIR = os.getenv("SESSION_STORAGE_DIR")
+
+# Append-only companion files of <id>.json (the session memory, see session_memory.py).
+# They live next to the session file and are archived, revived and deleted with it.
+SIDECAR_SUFFIXES = (".vectors", ".turns.jsonl")
 
 class StorageManager:
-    def __init__(self):
+    """Session files with a hash-sharded layout and a compressed cold archive.
+
+    Live sessions are stored as storage/sessions/ab/cd/<id>.json, where
+    "abcd" is the start of the SHA-1 of the session id. A background sweeper
+    moves sessions idle for SESSION_COLD_AFTER into storage/archive/ab/cd/<id>.json.gz
+    and deletes them once idle for SESSION_TTL. load_session reads and revives
+    archived sessions transparently, and moves sessions it finds in the old
+    flat sessions/<id>.json layout into their shard.
+
+    The sweeper only runs once start_sweeper() is called (the API does so on
+    startup), so importing this module never touches session files.
+    """
+
+    def __init__(self, storage_root: Path = None):
         # Get the absolute path to the backend directory
         backend_dir = Path(__file__).parent.parent.parent
-        self.storage_dir = backend_dir / "storage" / "sessions"
+        if storage_root is None:
+            storage_root = Path(SESSION_STORAGE_DIR) if SESSION_STORAGE_DIR else backend_dir / "storage"
+        self.storage_dir = storage_root / "sessions"
+        self.archive_dir = storage_root / "archive"
         print(f"Initializing storage at: {self.storage_dir}")
         self.storage_dir.mkdir(parents=True, exist_ok=True)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._eviction_listeners = []
+        self._session_lock = None
+        self.counts = {'live': 0, 'cold': 0}
+        self.totals = {'archived': 0, 'revived': 0, 'expired': 0}
+        self.last_sweep = None
+
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def start_sweeper(self, interval: float = SESSION_SWEEP_INTERVAL):
+        """Sweep in a background thread every `interval` seconds (0 disables it)"""
+        if interval <= 0 or self._sweeper is not None:
+            return
+        self._stop.clear()
+        self._sweeper = threading.Thread(
+            target=self._sweep_loop, args=(interval,), name="session-sweeper", daemon=True
+        )
+        self._sweeper.start()
+
+    def _shard(self, session_id: str) -> Path:
+        digest = hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+        return Path(digest[:2]) / digest[2:4]
 
     def _get_session_file(self, session_id: str) -> Path:
-        return self.storage_dir / f"{session_id}.json"
+        return self.storage_dir / self._shard(session_id) / f"{session_id}.json"
+
+    def _get_archive_file(self, session_id: str) -> Path:
+        return self.archive_dir / self._shard(session_id) / f"{session_id}.json.gz"
+
+    def _get_sidecar_file(self, session_id: str, suffix: str) -> Path:
+        if suffix not in SIDECAR_SUFFIXES:
+            raise ValueError(f"Unknown sidecar suffix: {suffix}")
+        return self.storage_dir / self._shard(session_id) / f"{session_id}{suffix}"
+
+    def _get_archived_sidecar_file(self, session_id: str, suffix: str) -> Path:
+        return self.archive_dir / self._shard(session_id) / f"{session_id}{suffix}.gz"
+
+    def add_eviction_listener(self, callback):
+        """Register callback(session_id), called when a session is archived or expired"""
+        self._eviction_listeners.append(callback)
+
+    def set_session_lock(self, factory):
+        """Register factory(session_id) -> lock held by requests using the session.
+
+        The sweeper only archives or expires a session while it can take that
+        lock without waiting, so sessions in use are left for the next sweep.
+        """
+        self._session_lock = factory
+
+    @contextmanager
+    def _idle_session(self, session_id: str):
+        lock = self._session_lock(session_id) if self._session_lock else None
+        if lock is not None and not lock.acquire(blocking=False):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _notify_evicted(self, session_id: str):
+        for callback in self._eviction_listeners:
+            try:
+                callback(session_id)
+            except Exception as e:
+                print(f"Error in session eviction listener: {str(e)}")
+
+    def _write_json(self, file_path: Path, session_data: dict):
+        # Write to a temporary file first so a crash never leaves a truncated session
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = file_path.with_suffix(".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(session_data, f)
+        os.replace(tmp_path, file_path)
+
+    def _write_bytes(self, file_path: Path, data: bytes):
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = file_path.with_suffix(".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+
+    def _revive_sidecars(self, session_id: str):
+        # Caller holds self._lock; live sidecars written since the archive win
+        for suffix in SIDECAR_SUFFIXES:
+            archived = self._get_archived_sidecar_file(session_id, suffix)
+            if not archived.exists():
+                continue
+            live = self._get_sidecar_file(session_id, suffix)
+            if not live.exists():
+                with gzip.open(archived, 'rb') as f:
+                    self._write_bytes(live, f.read())
+            archived.unlink()
+
+    def read_sidecar(self, session_id: str, suffix: str) -> bytes:
+        """Contents of a live session's sidecar file, or b"" if it has none"""
+        file_path = self._get_sidecar_file(session_id, suffix)
+        with self._lock:
+            if not file_path.exists():
+                return b""
+            with open(file_path, 'rb') as f:
+                return f.read()
+
+    def append_sidecar(self, session_id: str, suffix: str, data: bytes):
+        """Append to a live session's sidecar file"""
+        file_path = self._get_sidecar_file(session_id, suffix)
+        with self._lock:
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(file_path, 'ab') as f:
+                f.write(data)
+
+    def write_sidecar(self, session_id: str, suffix: str, data: bytes):
+        """Replace a live session's sidecar file"""
+        with self._lock:
+            self._write_bytes(self._get_sidecar_file(session_id, suffix), data)
 
     def save_session(self, session_id: str, session_data: dict):
         """Save session data to a JSON file"""
         file_path = self._get_session_file(session_id)
         print(f"Saving session {session_id} to {file_path}")
-        with open(file_path, 'w') as f:
-            json.dump(session_data, f)
+        with stage("storage.save"), self._lock:
+            self._write_json(file_path, session_data)
+            # A session cached in memory may have been archived meanwhile; the live copy wins
+            archive_path = self._get_archive_file(session_id)
+            if archive_path.exists():
+                self._revive_sidecars(session_id)
+                archive_path.unlink()
 
     def load_session(self, session_id: str) -> dict:
-        """Load session data from a JSON file"""
+        """Load session data from a JSON file, reviving it from the archive if needed"""
         file_path = self._get_session_file(session_id)
         print(f"Loading session {session_id} from {file_path}")
-        if file_path.exists():
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                print(f"Loaded session with {len(data['chat_history'])} messages and {len(data['memorized_key_messages'])} key points")
-                return data
+        with stage("storage.load"), self._lock:
+            data = None
+            if file_path.exists():
+                with open(file_path, 'r') as f:
+                    data = json.load(f)
+            else:
+                archive_path = self._get_archive_file(session_id)
+                if archive_path.exists():
+                    print(f"Reviving session {session_id} from {archive_path}")
+                    with gzip.open(archive_path, 'rt') as f:
+                        data = json.load(f)
+                    self._write_json(file_path, data)
+                    self._revive_sidecars(session_id)
+                    archive_path.unlink()
+                    self.totals['revived'] += 1
+                else:
+                    data = self._load_flat(session_id)
+
+        if data is not None:
+            print(f"Loaded session with {len(data['chat_history'])} messages and {len(data['memorized_key_messages'])} key points")
+            return data
         print(f"No existing session found for {session_id}")
         return {
             'chat_history': [],
@@ -38,12 +214,174 @@ class StorageManager:
     def delete_session(self, session_id: str):
         """Delete session data file"""
         file_path = self._get_session_file(session_id)
+        archive_path = self._get_archive_file(session_id)
         print(f"Deleting session {session_id} at {file_path}")
-        if file_path.exists():
-            file_path.unlink()
+        with self._lock:
+            found = file_path.exists() or archive_path.exists()
+            file_path.unlink(missing_ok=True)
+            archive_path.unlink(missing_ok=True)
+            for suffix in SIDECAR_SUFFIXES:
+                self._get_sidecar_file(session_id, suffix).unlink(missing_ok=True)
+                self._get_archived_sidecar_file(session_id, suffix).unlink(missing_ok=True)
+        if found:
             print(f"Session {session_id} deleted")
         else:
             print(f"No session file found to delete for {session_id}")
 
+    def _archive(self, file_path: Path, mtime: float) -> bool:
+        session_id = file_path.name[:-len(".json")]
+        with self._idle_session(session_id) as idle:
+            return idle and self._archive_idle(session_id, file_path, mtime)
+
+    def _archive_idle(self, session_id: str, file_path: Path, mtime: float) -> bool:
+        archive_path = self._get_archive_file(session_id)
+        with self._lock:
+            # Skip sessions saved again since the scan
+            if not file_path.exists() or file_path.stat().st_mtime != mtime:
+                return False
+            archive_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = archive_path.with_suffix(".tmp")
+            for suffix in SIDECAR_SUFFIXES:
+                sidecar = self._get_sidecar_file(session_id, suffix)
+                if sidecar.exists():
+                    archived = self._get_archived_sidecar_file(session_id, suffix)
+                    sidecar_tmp = archived.with_suffix(".tmp")
+                    with open(sidecar, 'rb') as src, gzip.open(sidecar_tmp, 'wb') as dst:
+                        dst.write(src.read())
+                    os.replace(sidecar_tmp, archived)
+                    sidecar.unlink()
+            with open(file_path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+                dst.write(src.read())
+            # Keep the last-activity time so the TTL still counts from it
+            os.utime(tmp_path, (mtime, mtime))
+            os.replace(tmp_path, archive_path)
+            file_path.unlink()
+        self._notify_evicted(session_id)
+        return True
+
+    def _expire(self, archive_path: Path, mtime: float) -> bool:
+        session_id = archive_path.name[:-len(".json.gz")]
+        with self._idle_session(session_id) as idle:
+            return idle and self._expire_idle(session_id, archive_path, mtime)
+
+    def _expire_idle(self, session_id: str, archive_path: Path, mtime: float) -> bool:
+        with self._lock:
+            if not archive_path.exists() or archive_path.stat().st_mtime != mtime:
+                return False
+            archive_path.unlink()
+            for suffix in SIDECAR_SUFFIXES:
+                self._get_archived_sidecar_file(session_id, suffix).unlink(missing_ok=True)
+        self._notify_evicted(session_id)
+        return True
+
+    def sweep(self, now: float = None) -> dict:
+        """Archive idle live sessions and delete expired ones; returns this sweep's counts"""
+        now = now or time.time()
+        result = {'live': 0, 'cold': 0, 'archived': 0, 'expired': 0}
+
+        for file_path in self.storage_dir.glob("*/*/*.json"):
+            try:
+                mtime = file_path.stat().st_mtime
+                if now - mtime >= SESSION_COLD_AFTER and self._archive(file_path, mtime):
+                    result['archived'] += 1
+                    continue
+                result['live'] += 1
+            except FileNotFoundError:
+                continue
+
+        for archive_path in self.archive_dir.glob("*/*/*.json.gz"):
+            try:
+                mtime = archive_path.stat().st_mtime
+                if now - mtime >= SESSION_TTL and self._expire(archive_path, mtime):
+                    result['expired'] += 1
+                    continue
+                result['cold'] += 1
+            except FileNotFoundError:
+                continue
+
+        self.counts = {'live': result['live'], 'cold': result['cold']}
+        self.totals['archived'] += result['archived']
+        self.totals['expired'] += result['expired']
+        self.last_sweep = now
+        print(f"Session sweep: {result}")
+        return result
+
+    def _sweep_loop(self, interval: float):
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Error sweeping sessions: {str(e)}")
+            self._stop.wait(interval)
+
+    def stop(self):
+        self._stop.set()
+        self._sweeper = None
+
+    def _migrate_flat_file(self, file_path: Path) -> bool:
+        # Caller holds self._lock. Other processes sharing the storage may be
+        # migrating the same file, so a vanished file is simply skipped.
+        target = self._get_session_file(file_path.name[:-len(".json")])
+        try:
+            if target.exists() and target.stat().st_mtime >= file_path.stat().st_mtime:
+                file_path.unlink()
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(file_path, target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _load_flat(self, session_id: str):
+        # Caller holds self._lock
+        file_path = self.storage_dir / f"{session_id}.json"
+        if not file_path.exists() or not self._migrate_flat_file(file_path):
+            return None
+        print(f"Moved session {session_id} from the flat layout into its shard")
+        try:
+            with open(self._get_session_file(session_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def migrate_flat_layout(self) -> int:
+        """Move sessions from the old flat sessions/<id>.json layout into shards"""
+        moved = 0
+        for file_path in self.storage_dir.glob("*.json"):
+            with self._lock:
+                if self._migrate_flat_file(file_path):
+                    moved += 1
+        if moved:
+            print(f"Migrated {moved} sessions to the sharded layout")
+        return moved
+
+    def stats(self) -> dict:
+        """Session counts as of the last sweep, plus lifetime counters"""
+        return {
+            'live': self.counts['live'],
+            'cold': self.counts['cold'],
+            'archived_total': self.totals['archived'],
+            'revived_total': self.totals['revived'],
+            'expired_total': self.totals['expired'],
+            'last_sweep': self.last_sweep,
+            'cold_after_seconds': SESSION_COLD_AFTER,
+            'ttl_seconds': SESSION_TTL
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Session storage maintenance")
+    parser.add_argument("command", choices=["migrate", "sweep"])
+    args = parser.parse_args(argv)
+
+    # One-shot maintenance: the background sweeper is never started here
+    if args.command == "migrate":
+        storage_manager.migrate_flat_layout()
+    else:
+        storage_manager.sweep()
+    print(json.dumps(storage_manager.stats(), indent=2))
+
 # Create singleton instance
-storage_manager = StorageManager() 
\ No newline at end of file
+storage_manager = StorageManager()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""Admin-only, on-demand profiling of the live API process.
+
+Everything here is dormant until an admin arms it through /admin/profile/*:
+
+- cpu:      time-boxed cProfile (.prof, open with snakeviz/pstats) or a
+            sampling profile of all threads (.folded, for flamegraph.pl/speedscope)
+- forward:  torch.profiler Chrome trace of CustomModel.forward
+- timeline: per-stage timings (tokenize, forward, Gemini, storage) of the next N requests
+
+When disarmed the hooks reduce to a global flag or ContextVar lookup.
+The routes reject every call unless ADMIN_TOKEN is set and sent back in
+the X-Admin-Token header.
+"""
+import asyncio
+import contextvars
+import cProfile
+import functools
+import hmac
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from pathlib import Path
+from dotenv import load_dotenv
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import FileResponse
+
+# Load environment variables
+load_dotenv()
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+MAX_PROFILE_SECONDS = 300
+MAX_TIMELINE_REQUESTS = 1000
+
+PROFILE_DIR = Path(__file__).parent.parent / "storage" / "profiles"
+
+_NULL_STAGE = nullcontext()
+_current_timeline = contextvars.ContextVar("profile_timeline", default=None)
+
+
+class _Stage:
+    def __init__(self, timeline, name: str):
+        self.timeline = timeline
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.timeline.stages.append({
+            "stage": self.name,
+            "start_ms": round((self.start - self.timeline.start) * 1000, 3),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "thread": threading.current_thread().name,
+        })
+        return False
+
+
+class Timeline:
+    """Stage timings of a single request"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.total_ms = None
+        self.stages = []
+
+    def finish(self):
+        self.total_ms = round((time.perf_counter() - self.start) * 1000, 3)
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "started_at": self.started_at,
+            "total_ms": self.total_ms,
+            "stages": self.stages,
+        }
+
+
+def stage(name: str):
+    """Time a block as one stage of the current request's timeline.
+
+    Returns a shared no-op context manager unless a timeline capture is armed
+    and this request was picked for it.
+    """
+    timeline = _current_timeline.get()
+    if timeline is None:
+        return _NULL_STAGE
+    return _Stage(timeline, name)
+
+
+class Profiler:
+    """Process-wide state of the on-demand profilers"""
+
+    def __init__(self, output_dir: Path):
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+        self.cpu_busy = False
+        # Set while a cProfile window is open; read by the `profiled` decorator
+        self.cprofile_active = False
+        self._thread_profiles = []
+        self.timeline_remaining = 0
+        self._timeline_inflight = 0
+        self._timelines = []
+        self.last_timeline_file = None
+
+    def _output_path(self, kind: str, suffix: str) -> Path:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        return self.output_dir / f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}{suffix}"
+
+    def _claim_cpu(self):
+        with self._lock:
+            if self.cpu_busy:
+                raise HTTPException(status_code=409, detail="A CPU profile is already running")
+            self.cpu_busy = True
+
+    async def capture_cprofile(self, seconds: float) -> Path:
+        """Deterministic profile of the event loop and of every endpoint call in the window"""
+        self._claim_cpu()
+        try:
+            loop_profile = cProfile.Profile()
+            self._thread_profiles = [loop_profile]
+            self.cprofile_active = True
+            loop_profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                loop_profile.disable()
+                self.cprofile_active = False
+
+            stats = pstats.Stats(*self._thread_profiles)
+            path = self._output_path("cprofile", ".prof")
+            stats.dump_stats(str(path))
+            return path
+        finally:
+            self._thread_profiles = []
+            self.cpu_busy = False
+
+    def _record_thread_profile(self, profile: cProfile.Profile):
+        with self._lock:
+            if self.cprofile_active:
+                self._thread_profiles.append(profile)
+
+    async def capture_sampling(self, seconds: float, interval: float) -> Path:
+        """Sample the stacks of all threads every `interval` seconds, in collapsed format"""
+        self._claim_cpu()
+        try:
+            samples = Counter()
+            stop = threading.Event()
+
+            def sample():
+                me = threading.get_ident()
+                while not stop.wait(interval):
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                    for ident, frame in sys._current_frames().items():
+                        if ident == me:
+                            continue
+                        stack = []
+                        while frame is not None:
+                            code = frame.f_code
+                            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                            frame = frame.f_back
+                        thread_name = names.get(ident, str(ident))
+                        samples[";".join([thread_name] + stack[::-1])] += 1
+
+            sampler = threading.Thread(target=sample, name="profile-sampler", daemon=True)
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop.set()
+                await asyncio.to_thread(sampler.join)
+
+            path = self._output_path("sampling", ".folded")
+            with open(path, 'w') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            return path
+        finally:
+            self.cpu_busy = False
+
+    def capture_forward(self, model_name: str, text: str, iterations: int) -> Path:
+        """Chrome trace of CustomModel.forward on an already-loaded classifier"""
+        import torch
+        from torch.profiler import ProfilerActivity, profile, record_function
+
+        if model_name == "mental_health":
+            from .models.mental_health_bert import mental_health_bert as classifier
+        else:
+            from .models.sentiment_bert import sentiment_bert as classifier
+
+        inputs = classifier.tokenizer(
+            text,
+            return_tensors="pt",
+            truncation=True,
+            max_length=512
+        ).to(classifier.device)
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+
+        with torch.no_grad():
+            classifier.model(**inputs)  # Warm-up so one-off allocations stay out of the trace
+            with profile(activities=activities, record_shapes=True, with_stack=True) as prof:
+                for _ in range(iterations):
+                    with record_function("CustomModel.forward"):
+                        classifier.model(**inputs)
+
+        path = self._output_path(f"forward-{model_name}", ".json")
+        prof.export_chrome_trace(str(path))
+        return path
+
+    def arm_timeline(self, requests: int):
+        with self._lock:
+            self.timeline_remaining = requests
+            self._timelines = []
+
+    def start_timeline(self, path: str):
+        """Claim a timeline slot for a request, or None when the capture is full"""
+        with self._lock:
+            if self.timeline_remaining <= 0:
+                return None
+            self.timeline_remaining -= 1
+            self._timeline_inflight += 1
+            return Timeline(path)
+
+    def finish_timeline(self, timeline: Timeline):
+        timeline.finish()
+        with self._lock:
+            self._timelines.append(timeline.to_dict())
+            self._timeline_inflight -= 1
+            if self.timeline_remaining > 0 or self._timeline_inflight > 0:
+                return
+            timelines, self._timelines = self._timelines, []
+
+        # Only the last request of the capture gets here
+        path = self._output_path("timeline", ".json")
+        with open(path, 'w') as f:
+            json.dump(timelines, f, indent=2)
+        self.last_timeline_file = path.name
+
+
+profiler = Profiler(PROFILE_DIR)
+
+
+def profiled(func):
+    """Let an endpoint running in the threadpool join an open cProfile window"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not profiler.cprofile_active:
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler already owns this thread
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            profiler._record_thread_profile(profile)
+    return wrapper
+
+
+class ProfilingMiddleware:
+    """Attach a stage timeline to requests while a timeline capture is armed"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or profiler.timeline_remaining <= 0 or scope["path"].startswith("/admin/"):
+            await self.app(scope, receive, send)
+            return
+
+        timeline = profiler.start_timeline(scope["path"])
+        if timeline is None:
+            await self.app(scope, receive, send)
+            return
+
+        token = _current_timeline.set(timeline)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_timeline.reset(token)
+            profiler.finish_timeline(timeline)
+
+
+def require_admin(x_admin_token: str = Header(default=None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+admin_router = APIRouter(prefix="/admin/profile", dependencies=[Depends(require_admin)])
+
+
+def _file_info(path: Path) -> dict:
+    return {"file": path.name, "download": f"/admin/profile/files/{path.name}"}
+
+
+@admin_router.post("/cpu")
+async def profile_cpu(seconds: float = 10.0, mode: str = "sampling", interval: float = 0.005):
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {MAX_PROFILE_SECONDS}]")
+    if mode == "cprofile":
+        path = await profiler.capture_cprofile(seconds)
+    elif mode == "sampling":
+        path = await profiler.capture_sampling(seconds, max(interval, 0.001))
+    else:
+        raise HTTPException(status_code=400, detail="mode must be 'cprofile' or 'sampling'")
+    return _file_info(path)
+
+
+@admin_router.post("/forward")
+def profile_forward(model: str = "sentiment", text: str = "I have been feeling anxious lately.", iterations: int = 5):
+    if model not in ("sentiment", "mental_health"):
+        raise HTTPException(status_code=400, detail="model must be 'sentiment' or 'mental_health'")
+    return _file_info(profiler.capture_forward(model, text, max(1, min(iterations, 100))))
+
+
+@admin_router.post("/timeline")
+async def arm_timeline(requests: int = 20):
+    if not 0 < requests <= MAX_TIMELINE_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"requests must be in (0, {MAX_TIMELINE_REQUESTS}]")
+    profiler.arm_timeline(requests)
+    return {"armed": requests}
+
+
+@admin_router.get("/timeline")
+async def timeline_status():
+    return {
+        "remaining": profiler.timeline_remaining,
+        "last_file": profiler.last_timeline_file,
+    }
+
+
+@admin_router.get("/files")
+async def list_profiles():
+    if not PROFILE_DIR.exists():
+        return {"files": []}
+    return {"files": sorted(p.name for p in PROFILE_DIR.iterdir() if p.is_file())}
+
+
+@admin_router.get("/files/{name}")
+async def download_profile(name: str):
+    path = PROFILE_DIR / name
+    if path.name != name or not path.is_file():
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, filename=name)
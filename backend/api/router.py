@@ -0,0 +1,399 @@
+"""Session-affinity router for running the API as several processes or nodes.
+
+Every request carrying a session_id (JSON body or /key-points/{session_id})
+is sent to the backend that owns the session on a consistent-hash ring, so
+consecutive turns always reach the process holding the live copy of the
+session. Requests without a session are spread round-robin, except the
+per-process /admin/* and /metrics routes, which go to the backend named in
+the X-Backend header (one of the URLs listed by /router/status).
+
+When backends join or leave, only the sessions whose ring owner changed move.
+Once such a session has no request in flight, and before it is served again,
+the router asks the previous owner for its data (POST
+/internal/sessions/{id}/release), hands it to the new owner (PUT
+/internal/sessions/{id}) and only then has the previous owner delete its copy
+(DELETE /internal/sessions/{id}). If the new owner refuses, the session stays
+where it was. A removed backend should stay up until /router/status shows it
+drained.
+
+Run locally with three API processes behind the router on port 8000:
+
+    python -m backend.api.router --spawn 3 --port 8000
+
+Each spawned process gets its own SESSION_STORAGE_DIR under backend/storage/backends/.
+Or point the router at running backends, each started with the same
+ROUTER_SECRET and its own SESSION_STORAGE_DIR (a handoff deletes the previous
+owner's copy, so backends must never share session storage):
+
+    ROUTER_BACKENDS=http://10.0.0.5:8000,http://10.0.0.6:8000 python -m backend.api.router
+
+The owner map lives in router memory; if the router restarts while the
+membership is changing, sessions it had not handed off yet start fresh on
+their new owner.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import secrets
+import subprocess
+import sys
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+from urllib.parse import quote
+import httpx
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+# Load environment variables
+load_dotenv()
+ROUTER_SECRET = os.getenv("ROUTER_SECRET")
+ROUTER_BACKENDS = [b.strip().rstrip("/") for b in os.getenv("ROUTER_BACKENDS", "").split(",") if b.strip()]
+ROUTER_VIRTUAL_NODES = int(os.getenv("ROUTER_VIRTUAL_NODES", "100"))
+ROUTER_MAX_TRACKED_SESSIONS = int(os.getenv("ROUTER_MAX_TRACKED_SESSIONS", "100000"))
+ROUTER_TIMEOUT = float(os.getenv("ROUTER_TIMEOUT", "120"))
+
+# Hop-by-hop headers that must not be forwarded by a proxy
+HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "upgrade", "host", "content-length"}
+
+
+class HashRing:
+    """Consistent-hash ring with virtual nodes"""
+
+    def __init__(self, virtual_nodes: int = ROUTER_VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.backends = []
+        self._keys = []
+        self._owners = []
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def _rebuild(self):
+        points = sorted(
+            (self._hash(f"{backend}#{i}"), backend)
+            for backend in self.backends
+            for i in range(self.virtual_nodes)
+        )
+        self._keys = [key for key, _ in points]
+        self._owners = [backend for _, backend in points]
+
+    def add(self, backend: str):
+        if backend not in self.backends:
+            self.backends.append(backend)
+            self._rebuild()
+
+    def remove(self, backend: str):
+        if backend in self.backends:
+            self.backends.remove(backend)
+            self._rebuild()
+
+    def get(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._owners[index]
+
+
+class _SessionSlot:
+    """Requests in flight for one session; handoffs wait until there are none"""
+
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.inflight = 0
+
+
+class SessionRouter:
+    """Routing state: the ring, the last known owner of each session and handoff counters"""
+
+    def __init__(self, backends, secret: str):
+        self.ring = HashRing()
+        for backend in backends:
+            self.ring.add(backend)
+        self.secret = secret
+        self.owners = OrderedDict()  # session_id -> backend that last served it, in LRU order
+        self._slots = {}
+        self._round_robin = itertools.count()
+        self.client = None
+        self.rebalance_task = None
+        self.stats = {"proxied": 0, "handoffs": 0, "handoff_failures": 0, "backend_errors": 0, "rebalance_errors": 0}
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=ROUTER_TIMEOUT)
+
+    async def stop(self):
+        await self.client.aclose()
+
+    def _remember(self, session_id: str, backend: str):
+        self.owners[session_id] = backend
+        self.owners.move_to_end(session_id)
+        while len(self.owners) > ROUTER_MAX_TRACKED_SESSIONS:
+            old_session, _ = self.owners.popitem(last=False)
+            slot = self._slots.get(old_session)
+            if slot is not None and slot.inflight == 0:
+                del self._slots[old_session]
+
+    async def handoff(self, session_id: str, source: str, target: str) -> str:
+        """Move an idle session from its previous owner to its ring owner; returns the backend now holding it"""
+        headers = {"X-Router-Secret": self.secret}
+        url = f"/internal/sessions/{quote(session_id, safe='')}"
+        try:
+            released = await self.client.post(f"{source}{url}/release", headers=headers)
+            released.raise_for_status()
+        except httpx.HTTPError as e:
+            # The previous owner is gone or refused; the new owner continues from its own storage
+            self.stats["handoff_failures"] += 1
+            print(f"Could not release session {session_id} from {source}: {str(e)}")
+            return target
+
+        try:
+            adopted = await self.client.put(f"{target}{url}", headers=headers, json=released.json())
+            adopted.raise_for_status()
+        except httpx.HTTPError as e:
+            # The previous owner still has its stored copy, so the session stays there
+            self.stats["handoff_failures"] += 1
+            print(f"Could not hand session {session_id} to {target}: {str(e)}")
+            return source
+
+        try:
+            dropped = await self.client.delete(f"{source}{url}", headers=headers)
+            dropped.raise_for_status()
+        except httpx.HTTPError as e:
+            # Harmless: a later handoff back to the source overwrites the stale copy
+            print(f"Could not drop session {session_id} from {source}: {str(e)}")
+        self.stats["handoffs"] += 1
+        return target
+
+    @asynccontextmanager
+    async def route(self, session_id: Optional[str]):
+        """Pick the backend for a request and count it as in flight until the block exits.
+
+        If the session's owner changed, the handoff waits for the session's
+        in-flight requests to finish; new requests for it wait for the handoff.
+        """
+        if not self.ring.backends:
+            raise HTTPException(status_code=503, detail="No backends available")
+        if not session_id:
+            backends = self.ring.backends
+            yield backends[next(self._round_robin) % len(backends)]
+            return
+
+        slot = self._slots.setdefault(session_id, _SessionSlot())
+        async with slot.condition:
+            while True:
+                target = self.ring.get(session_id)
+                previous = self.owners.get(session_id)
+                if not previous or previous == target:
+                    break
+                if slot.inflight:
+                    await slot.condition.wait()
+                    continue
+                target = await self.handoff(session_id, previous, target)
+                break
+            self._remember(session_id, target)
+            slot.inflight += 1
+        try:
+            yield target
+        finally:
+            async with slot.condition:
+                slot.inflight -= 1
+                slot.condition.notify_all()
+
+    async def rebalance(self):
+        """Eagerly hand off every tracked session whose ring owner changed"""
+        moved = [sid for sid, owner in list(self.owners.items()) if owner != self.ring.get(sid)]
+        for session_id in moved:
+            async with self.route(session_id):
+                pass
+        if moved:
+            print(f"Rebalanced {len(moved)} sessions")
+
+    def schedule_rebalance(self):
+        """Rebalance in the background, after any rebalance still running"""
+        previous = self.rebalance_task
+
+        async def run():
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            await self.rebalance()
+
+        # Keep a reference so the task is not garbage-collected before it finishes
+        self.rebalance_task = asyncio.create_task(run())
+        self.rebalance_task.add_done_callback(self._rebalance_done)
+
+    def _rebalance_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.stats["rebalance_errors"] += 1
+            print(f"Error rebalancing sessions: {task.exception()!r}")
+
+    def draining(self) -> dict:
+        """Backends no longer on the ring that still own tracked sessions"""
+        counts = {}
+        for owner in self.owners.values():
+            if owner not in self.ring.backends:
+                counts[owner] = counts.get(owner, 0) + 1
+        return counts
+
+
+router = SessionRouter(ROUTER_BACKENDS, ROUTER_SECRET)
+app = FastAPI(title="CounselBot Router")
+
+
+class BackendRequest(BaseModel):
+    url: str
+
+
+def require_secret(x_router_secret: Optional[str]):
+    if not router.secret or not x_router_secret or not hmac.compare_digest(x_router_secret, router.secret):
+        raise HTTPException(status_code=403, detail="Invalid router secret")
+
+
+@app.on_event("startup")
+async def startup():
+    await router.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await router.stop()
+
+
+@app.get("/router/status")
+async def router_status():
+    return {
+        "backends": router.ring.backends,
+        "draining": router.draining(),
+        "tracked_sessions": len(router.owners),
+        "rebalancing": router.rebalance_task is not None and not router.rebalance_task.done(),
+        **router.stats
+    }
+
+
+@app.post("/router/backends")
+async def add_backend(request: BackendRequest, x_router_secret: Optional[str] = Header(default=None)):
+    require_secret(x_router_secret)
+    router.ring.add(request.url.rstrip("/"))
+    router.schedule_rebalance()
+    return {"backends": router.ring.backends}
+
+
+@app.delete("/router/backends")
+async def remove_backend(request: BackendRequest, x_router_secret: Optional[str] = Header(default=None)):
+    require_secret(x_router_secret)
+    router.ring.remove(request.url.rstrip("/"))
+    router.schedule_rebalance()
+    return {"backends": router.ring.backends}
+
+
+def _session_id(path: str, body: bytes) -> Optional[str]:
+    if path.startswith("key-points/"):
+        return path[len("key-points/"):] or None
+    if not body:
+        return None
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    return payload.get("session_id") if isinstance(payload, dict) else None
+
+
+def _named_backend(request: Request) -> str:
+    # Profiles and metrics live in one backend process, so the caller must say which
+    backend = (request.headers.get("x-backend") or "").rstrip("/")
+    known = router.ring.backends + [b for b in router.draining() if b not in router.ring.backends]
+    if backend not in known:
+        raise HTTPException(
+            status_code=400,
+            detail=f"This route is per backend; name one in the X-Backend header: {', '.join(known)}"
+        )
+    return backend
+
+
+async def _forward(request: Request, backend: str, path: str, body: bytes) -> httpx.Response:
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS and k.lower() != "x-backend"}
+    try:
+        return await router.client.request(
+            request.method,
+            f"{backend}/{path}",
+            params=request.query_params,
+            headers=headers,
+            content=body
+        )
+    except httpx.HTTPError as e:
+        router.stats["backend_errors"] += 1
+        raise HTTPException(status_code=502, detail=f"Backend {backend} unavailable: {str(e)}")
+
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
+async def proxy(path: str, request: Request):
+    if path.startswith("internal/"):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    body = await request.body()
+    if path.startswith("admin/") or path == "metrics":
+        upstream = await _forward(request, _named_backend(request), path, body)
+    else:
+        # The session cannot be handed off while its request is running on the backend
+        async with router.route(_session_id(path, body)) as backend:
+            upstream = await _forward(request, backend, path, body)
+
+    router.stats["proxied"] += 1
+    response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS}
+    return Response(content=upstream.content, status_code=upstream.status_code, headers=response_headers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Session-affinity router for the CounselBot API")
+    parser.add_argument("--host", default=os.getenv("API_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", "8000")))
+    parser.add_argument("--spawn", type=int, default=0, help="start this many local API processes as backends")
+    parser.add_argument("--backend-port", type=int, default=8001, help="first port for spawned backends")
+    parser.add_argument("--storage-root", type=Path,
+                        default=Path(__file__).parent.parent / "storage" / "backends",
+                        help="spawned backends store sessions in <storage-root>/<port>")
+    args = parser.parse_args(argv)
+
+    processes = []
+    if args.spawn:
+        router.secret = router.secret or secrets.token_hex(16)
+        for i in range(args.spawn):
+            port = args.backend_port + i
+            # Separate storage per backend, so a handoff's drop on the old owner
+            # cannot delete the new owner's copy and sweepers never overlap
+            env = dict(os.environ, ROUTER_SECRET=router.secret,
+                       SESSION_STORAGE_DIR=str(args.storage_root / str(port)))
+            processes.append(subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "backend.api.inference:app",
+                 "--host", "127.0.0.1", "--port", str(port)],
+                env=env
+            ))
+            router.ring.add(f"http://127.0.0.1:{port}")
+
+    if not router.ring.backends:
+        parser.error("no backends: set ROUTER_BACKENDS or use --spawn")
+    if not router.secret:
+        print("ROUTER_SECRET is not set; session handoff between backends is disabled")
+
+    try:
+        uvicorn.run(app, host=args.host, port=args.port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,30 @@
+"""RunPod serverless entry point.
+
+`handler` is an async generator: RunPod runs up to RUNPOD_MAX_CONCURRENCY jobs
+at once on one worker, and counsel replies are streamed to /stream/{job_id}
+as Gemini produces them. Other endpoints yield a single result.
+
+Output contract: because the handler is a generator, RunPod aggregates what it
+yields, so `output` on /runsync and /status is a list of chunks for every
+endpoint, not a single {status, data} object. The last element is the final
+result (what `output` used to be); for "counsel" and "all" it is preceded by
+{"status": "streaming", "data": {"delta": ...}} chunks. /stream/{job_id}
+returns the same chunks as {"output": chunk} items while the job runs.
+
+Local testing without Gemini:
+
+    GEMINI_BACKEND=stub python backend/runpod_handler.py \
+        --test_input '{"input": {"endpoint": "counsel", "prompt": "I feel stuck"}}'
+
+or serve RunPod's local API (/run, /runsync, /stream) with --rp_serve_api.
+"""
 import runpod
-import json
+import asyncio
+import os
 import uuid
 from backend.api.inference import (
     predict_sentiment,
     classify_mental_health,
-    generate_response,
     clear_history,
     AnalysisResponse,
     SentimentResponse,
@@ -12,26 +32,46 @@ from backend.api.inference import (
     LlamaResponse,
     KeyPointsResponse
 )
+from backend.api.models.gemini_counsel import generate_response_stream
+from backend.api.models.storage_manager import storage_manager
+
+# Jobs one worker runs at once; counsel jobs mostly wait on Gemini, so this can exceed the CPU count
+RUNPOD_MAX_CONCURRENCY = int(os.getenv("RUNPOD_MAX_CONCURRENCY", "8"))
+
+_STREAM_END = object()
 
-def handler(event):
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Tell RunPod how many jobs this worker may take concurrently"""
+    return RUNPOD_MAX_CONCURRENCY
+
+async def stream_counsel(prompt: str, session_id: str):
+    """Drive the blocking Gemini stream from a worker thread, one chunk at a time"""
+    stream = generate_response_stream(prompt, session_id)
+    while True:
+        item = await asyncio.to_thread(next, stream, _STREAM_END)
+        if item is _STREAM_END:
+            return
+        yield item
+
+async def handler(event):
     """
     This is the main handler function that RunPod will call.
     """
     try:
         # Get the input from the event
         input_data = event["input"]
-        
+
         # Extract common parameters
         prompt = input_data.get("prompt", "")
         clear_history_flag = input_data.get("clear_history", False)
         session_id = input_data.get("session_id", str(uuid.uuid4()))
-        
+
         # Determine which endpoint to call based on the input
         endpoint = input_data.get("endpoint", "all")
-        
+
         if endpoint == "sentiment":
-            result = predict_sentiment(prompt)
-            return {
+            result = await asyncio.to_thread(predict_sentiment, prompt)
+            yield {
                 "status": "success",
                 "data": {
                     "sentiment": result["sentiment"],
@@ -39,8 +79,8 @@ def handler(event):
                 }
             }
         elif endpoint == "mental-health":
-            result = classify_mental_health(prompt)
-            return {
+            result = await asyncio.to_thread(classify_mental_health, prompt)
+            yield {
                 "status": "success",
                 "data": {
                     "condition": result["condition"],
@@ -49,20 +89,29 @@ def handler(event):
             }
         elif endpoint == "counsel":
             if clear_history_flag:
-                clear_history(session_id)
-            response, key_points = generate_response(prompt, session_id)
-            return {
-                "status": "success",
-                "data": {
-                    "response": response,
-                    "key_points": key_points,
-                    "session_id": session_id
-                }
-            }
+                await asyncio.to_thread(clear_history, session_id)
+            async for item in stream_counsel(prompt, session_id):
+                if "delta" in item:
+                    yield {
+                        "status": "streaming",
+                        "data": {
+                            "delta": item["delta"],
+                            "session_id": session_id
+                        }
+                    }
+                else:
+                    yield {
+                        "status": "success",
+                        "data": {
+                            "response": item["response"],
+                            "key_points": item["key_points"],
+                            "session_id": session_id
+                        }
+                    }
         elif endpoint == "key-points":
             from backend.api.models.gemini_counsel import gemini_counsel
-            session = gemini_counsel.get_session(session_id)
-            return {
+            session = await asyncio.to_thread(gemini_counsel.get_session, session_id)
+            yield {
                 "status": "success",
                 "data": {
                     "key_points": session['memorized_key_messages'],
@@ -71,12 +120,13 @@ def handler(event):
             }
         elif endpoint == "clear-history":
             if not session_id:
-                return {
+                yield {
                     "status": "error",
                     "error": "session_id is required"
                 }
-            clear_history(session_id)
-            return {
+                return
+            await asyncio.to_thread(clear_history, session_id)
+            yield {
                 "status": "success",
                 "data": {
                     "message": "History cleared successfully",
@@ -86,29 +136,48 @@ def handler(event):
         else:  # "all" endpoint
             # Clear history if requested
             if clear_history_flag:
-                clear_history(session_id)
-                
-            # Get all analyses
-            sentiment_result = predict_sentiment(prompt)
-            mental_health_result = classify_mental_health(prompt)
-            response, key_points = generate_response(prompt, session_id)
-            
-            return {
-                "status": "success",
-                "data": {
-                    "response": response,
-                    "sentiment": sentiment_result,
-                    "mental_health": mental_health_result,
-                    "key_points": key_points,
-                    "session_id": session_id
-                }
-            }
-            
+                await asyncio.to_thread(clear_history, session_id)
+
+            # Run both classifiers side by side, then stream the reply
+            sentiment_result, mental_health_result = await asyncio.gather(
+                asyncio.to_thread(predict_sentiment, prompt),
+                asyncio.to_thread(classify_mental_health, prompt)
+            )
+            async for item in stream_counsel(prompt, session_id):
+                if "delta" in item:
+                    yield {
+                        "status": "streaming",
+                        "data": {
+                            "delta": item["delta"],
+                            "session_id": session_id
+                        }
+                    }
+                else:
+                    yield {
+                        "status": "success",
+                        "data": {
+                            "response": item["response"],
+                            "sentiment": sentiment_result,
+                            "mental_health": mental_health_result,
+                            "key_points": item["key_points"],
+                            "session_id": session_id
+                        }
+                    }
+
     except Exception as e:
-        return {
+        yield {
             "status": "error",
             "error": str(e)
         }
 
-# Start the RunPod serverless function
-runpod.serverless.start({"handler": handler}) 
\ No newline at end of file
+if __name__ == "__main__":
+    # The worker does not run the FastAPI startup hooks, so start the session sweeper here
+    storage_manager.start_sweeper()
+
+    # Start the RunPod serverless function
+    runpod.serverless.start({
+        "handler": handler,
+        "concurrency_modifier": concurrency_modifier,
+        # /runsync and /status return the list of yielded chunks as `output`; see the module docstring
+        "return_aggregate_stream": True
+    })
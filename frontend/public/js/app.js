@@ -400,7 +400,7 @@ const chatManager = {
                 
                 // If the request is queued, poll for status
                 if (data.status === 'IN_QUEUE' || data.status === 'IN_PROGRESS') {
-                    const result = await this.pollForResult(data.id);
+                    const result = await this.streamForResult(data.id, (text) => this.showPartialResponse(text));
                     
                     // Remove typing indicator
                     const existingTypingContainers = this.chatMessages.querySelectorAll('.typing-container');
@@ -519,13 +519,28 @@ const chatManager = {
         }
     },
 
-    async pollForResult(jobId) {
-        const maxAttempts = 30; // Maximum number of polling attempts
-        const pollInterval = 2000; // Poll every 2 seconds
-        
+    showPartialResponse(text) {
+        // Render the reply streamed so far in place of the typing indicator
+        const typingContainers = this.chatMessages.querySelectorAll('.typing-container');
+        const container = typingContainers[typingContainers.length - 1];
+        if (!container) return;
+
+        container.firstElementChild.textContent = text;
+        this.chatMessages.scrollTo({
+            top: this.chatMessages.scrollHeight,
+            behavior: 'smooth'
+        });
+    },
+
+    async streamForResult(jobId, onPartial) {
+        const maxAttempts = 600; // Maximum number of stream polls
+        const pollInterval = 250; // Each call returns only the output produced since the last one
+        let partialText = '';
+        let finalOutput = null;
+
         for (let attempt = 0; attempt < maxAttempts; attempt++) {
             try {
-                const response = await fetch(`${config.statusUrl}/${jobId}`, {
+                const response = await fetch(`${config.streamUrl}/${jobId}`, {
                     headers: {
                         'Authorization': `Bearer ${config.apiKey}`,
                         'Content-Type': 'application/json'
@@ -537,9 +552,26 @@ const chatManager = {
                 }
 
                 const data = await response.json();
-                
+
+                for (const chunk of data.stream || []) {
+                    const output = chunk.output;
+                    if (!output) continue;
+
+                    if (output.status === 'streaming') {
+                        partialText += output.data.delta;
+                        onPartial(partialText);
+                    } else if (output.status === 'error') {
+                        throw new Error(output.error);
+                    } else {
+                        finalOutput = output;
+                    }
+                }
+
                 if (data.status === 'COMPLETED') {
-                    return data;
+                    if (!finalOutput) {
+                        throw new Error('Job completed without a result');
+                    }
+                    return { output: finalOutput };
                 } else if (data.status === 'FAILED') {
                     throw new Error('Job failed');
                 }
@@ -547,12 +579,12 @@ const chatManager = {
                 // Wait before next poll
                 await new Promise(resolve => setTimeout(resolve, pollInterval));
             } catch (error) {
-                console.error('Error polling for result:', error);
+                console.error('Error streaming result:', error);
                 throw error;
             }
         }
 
-        throw new Error('Polling timeout');
+        throw new Error('Streaming timeout');
     },
 
     handleInputChange() {
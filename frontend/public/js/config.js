@@ -16,6 +16,11 @@ const config = {
     statusUrl: isDevelopment
         ? 'http://localhost:8000/status'
         : 'https://api.runpod.ai/v2/xkuvxoekj7yphp/status',
+
+    // RunPod stream endpoint, returns partial output as the reply is generated
+    streamUrl: isDevelopment
+        ? 'http://localhost:8000/stream'
+        : 'https://api.runpod.ai/v2/xkuvxoekj7yphp/stream',
     
     // API endpoints (these are logical names, the actual call goes through the single RunPod endpoint)
     endpoints: {